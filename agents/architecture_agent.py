@@ -2,49 +2,59 @@ from tools.diagrams_adapter import generate_architecture
 from tools.plantuml import build_cloud_arch_puml
 import os
 import re
-from tools import mcp_client
+import asyncio
+from tools import aio, mcp_client
 
 # ArchitectureAgent class to generate architecture diagrams
 class ArchitectureAgent:
-    def __init__(self, workdir):
+    def __init__(self, workdir, max_workers=1):
         self.workdir = workdir
+        self.max_workers = max(1, max_workers or 1)
     def run(self, context):
+        return aio.run(self.arun(context))
+    async def arun(self, context):
+        sem = asyncio.Semaphore(self.max_workers)
+        async def one(p):
+            async with sem:
+                return await self._arun_provider(p, context)
+        return self._merge(await asyncio.gather(*(one(p) for p in context["prefs"].get("providers", []))))
+    def _merge(self, results):
         images = []
         texts = []
-        providers = context["prefs"].get("providers", [])
-        for p in providers:
-            path = generate_architecture(p, context["data"], self.workdir)
-            if path:
-                images.append(path)
-            if p in ["aws","gcp"]:
-                text_hint = (context.get("data",{}).get("spec_text","") + "\n" + context.get("data",{}).get("prompt",""))
-                texts.append(build_cloud_arch_puml(p, services=None, text_hint=text_hint))
-            if p == "aws" and os.environ.get("AWS_DOCS_MCP_CMD"):
-                text_blob = (context.get("data",{}).get("spec_text","") + "\n" + context.get("data",{}).get("prompt","")).lower()
-                keys = ["vpc","elb","api gateway","ec2","lambda","dynamodb","rds","s3","cloudfront","route53"]
-                terms = [k for k in keys if re.search(rf"\\b{k}\\b", text_blob)]
-                seen = set()
-                for term in terms[:3]:
-                    if term in seen:
-                        continue
-                    seen.add(term)
-                    q = f"AWS {term} architecture best practices"
-                    res = mcp_client.aws_docs_search(q)
-                    url = None
-                    if isinstance(res, dict) and res.get("text"):
-                        for part in str(res.get("text","")).split():
-                            if part.startswith("http"):
-                                url = part
-                                break
-                    elif isinstance(res, str):
-                        for part in res.split():
-                            if part.startswith("http"):
-                                url = part
-                                break
-                    if url:
-                        page = mcp_client.aws_docs_read(url)
-                        if isinstance(page, dict) and page.get("text"):
-                            texts.append(page["text"])
-                        elif isinstance(page, str):
-                            texts.append(page)
+        # Provider results are merged in the order providers were requested
+        for p_images, p_texts in results:
+            images.extend(p_images)
+            texts.extend(p_texts)
         return {"images": images, "texts": texts}
+    async def _arun_provider(self, p, context):
+        queries = self._doc_queries(p, context)
+        # The docs fetch is network-bound: start it first so it overlaps with drawing
+        fetch = asyncio.ensure_future(mcp_client.aws_docs_fetch_many_async(queries)) if queries else None
+        try:
+            # Graphviz rendering in the diagrams library blocks, so it runs on a worker thread
+            images, texts = await asyncio.to_thread(self._draw, p, context)
+        except BaseException:
+            if fetch is not None:
+                fetch.cancel()
+            raise
+        if fetch is not None:
+            for page in await fetch:
+                texts.append(page["text"])
+        return images, texts
+    def _draw(self, p, context):
+        images = []
+        texts = []
+        path = generate_architecture(p, context["data"], self.workdir)
+        if path:
+            images.append(path)
+        if p in ["aws","gcp"]:
+            text_hint = (context.get("data",{}).get("spec_text","") + "\n" + context.get("data",{}).get("prompt",""))
+            texts.append(build_cloud_arch_puml(p, services=None, text_hint=text_hint))
+        return images, texts
+    def _doc_queries(self, p, context):
+        if p != "aws" or not os.environ.get("AWS_DOCS_MCP_CMD"):
+            return []
+        text_blob = (context.get("data",{}).get("spec_text","") + "\n" + context.get("data",{}).get("prompt","")).lower()
+        keys = ["vpc","elb","api gateway","ec2","lambda","dynamodb","rds","s3","cloudfront","route53"]
+        terms = [k for k in keys if re.search(rf"\b{re.escape(k)}\b", text_blob)]
+        return [f"AWS {term} architecture best practices" for term in terms[:3]]
@@ -7,4 +7,5 @@ class TopologyAgent:
     def run(self, context):
         code = generate_topology(context["prefs"].get("providers", []), context["data"]) 
         return {"images": [], "texts": [code]}
-
+    async def arun(self, context):
+        return self.run(context)
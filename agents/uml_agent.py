@@ -1,24 +1,29 @@
-from tools.plantuml import generate_uml, render_png
+from tools.plantuml import generate_uml, arender_many
+from tools import aio
 from tools.mermaid import generate_mermaid
 import os
 # UmlAgent class to generate UML diagrams
 class UmlAgent:
     def __init__(self, workdir):
         self.workdir = workdir
-    def run(self, context):
-        images = []
+    def _jobs(self, context):
         texts = []
-        types_ = context["prefs"].get("uml_types", [])
-        for t in types_:
+        jobs = []
+        for t in context["prefs"].get("uml_types", []):
             txt = generate_uml(t, context["data"])
             texts.append(txt)
             name = f"uml_{t}.png"
-            out = os.path.join(self.workdir, name)
-            img = render_png(txt, out)
-            if img:
-                images.append(img)
-        for t in types_:
+            jobs.append((txt, os.path.join(self.workdir, name)))
+        return texts, jobs
+    def _collect(self, context, texts, rendered):
+        images = [img for img in rendered if img]
+        for t in context["prefs"].get("uml_types", []):
             m = generate_mermaid(t, context["data"])
             texts.append(m)
         return {"images": images, "texts": texts}
-
+    def run(self, context):
+        return aio.run(self.arun(context))
+    async def arun(self, context):
+        texts, jobs = self._jobs(context)
+        # One batch so the backend can render the diagrams concurrently
+        return self._collect(context, texts, await arender_many(jobs))
@@ -1,91 +1,118 @@
 import gradio as gr
 import os
-from tools.llm_router import route, preflight
+import asyncio
+from tools import aio
+from tools.env import env_flag, env_int
+from tools.artifacts import get_store
+from tools.llm_router import route, aroute_stream, preflight, LLMError
 from core.orchestrator import Orchestrator
-from core.planner import make_plan
+from core.planner import amake_plan, needs_llm
 from core.validator import validate_plan
-from core.executor import execute
-import concurrent.futures
+from core.executor import aexecute, Speculation
 import logging
 
-def _env_bool(name: str, default: bool = False) -> bool:
-    val = os.environ.get(name)
-    if val is None:
-        return default
-    return str(val).strip().lower() in ("1", "true", "yes", "on")
-
 def _mcp_tools_ready() -> bool:
     return bool(os.environ.get("AWS_DIAGRAM_MCP_CMD") or os.environ.get("AWS_DOCS_MCP_CMD"))
 
 def _use_mcp_first() -> bool:
-    return _env_bool("USE_MCP_FIRST", False) and _mcp_tools_ready()
+    return env_flag("USE_MCP_FIRST", False) and _mcp_tools_ready()
 
-def run_llm(documents, images, models, message, history, timeout=30):
+def run_llm(documents, images, models, message, history):
     sel_models = models if isinstance(models, (list, tuple)) else ([models] if models else [])
     prompt_history = (history or []) + [{"role": "user", "content": message or ""}]
     pf = preflight(sel_models)
     if pf and not any(pf.values()):
         return "Error connecting/API key: Please check API key and internet connection."
-    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
-        for attempt in range(2):
-            future = executor.submit(route, sel_models, documents, prompt_history, images)
-            try:
-                return future.result(timeout=timeout)
-            except concurrent.futures.TimeoutError:
-                future.cancel()
-                logging.exception("LLM timeout")
-                if attempt == 0:
-                    continue
-                return f"Error: LLM did not respond after {timeout}s (timeout)."
-            except Exception as e:
-                logging.exception("LLM call failed")
-                if attempt == 0:
-                    continue
-                return f"Error calling LLM: {e}"
-
-def run_tools_and_draw(documents, message):
-    orch = Orchestrator(os.path.join(os.getcwd(), "outputs"))
-    out = orch.run(documents, message)
+    # Timeouts, retries across models and unhealthy-provider skipping live in llm_router
+    try:
+        return route(sel_models, documents, prompt_history, images)
+    except LLMError as e:
+        logging.warning("LLM call failed: %s", e)
+        return f"Error calling LLM: {e}"
+
+def _tools_summary(out):
     summary = "Generated specs.md and diagrams. Files:\n" + "\n".join(out.get("images", []))
     code = "\n\n" + "\n\n".join(out.get("texts", [])) if out.get("texts") else ""
     return summary + code
 
+def run_tools_and_draw(documents, message, docs=None, specs=None):
+    return aio.run(arun_tools_and_draw(documents, message, docs, specs))
+
+async def arun_tools_and_draw(documents, message, docs=None, specs=None):
+    store = get_store()
+    workdir = store.open_request()
+    try:
+        orch = Orchestrator(workdir)
+        return _tools_summary(await orch.arun(documents, message, docs=docs, specs_md=specs))
+    finally:
+        await asyncio.to_thread(store.close_request, workdir)
+
 def run_agent(documents, images, models, message, history):
-    plan = make_plan(models, documents, images, message, history)
-    vplan = validate_plan(plan)
-    return execute(vplan, documents, images, message)
+    return aio.run(arun_agent(documents, images, models, message, history))
+
+async def arun_agent(documents, images, models, message, history):
+    # Each request gets its own output namespace, shared by the speculative chain and the plan
+    store = get_store()
+    workdir = store.open_request()
+    # While an LLM planning call is in flight, start the default chain; execute() adopts what the plan keeps
+    spec = None
+    if env_flag("PLAN_SPECULATE", False) and needs_llm(message):
+        spec = Speculation(documents, message, workdir)
+    try:
+        plan = await amake_plan(models, documents, images, message, history)
+        vplan = validate_plan(plan)
+        return await aexecute(vplan, documents, images, message, speculation=spec, workdir=workdir)
+    finally:
+        if spec is not None:
+            spec.discard()
+        await asyncio.to_thread(store.close_request, workdir)
+
+async def arun_llm_stream(documents, images, models, message, history):
+    sel_models = models if isinstance(models, (list, tuple)) else ([models] if models else [])
+    prompt_history = (history or []) + [{"role": "user", "content": message or ""}]
+    pf = preflight(sel_models)
+    if pf and not any(pf.values()):
+        yield "Error connecting/API key: Please check API key and internet connection."
+        return
+    try:
+        async for delta in aroute_stream(sel_models, documents, prompt_history, images):
+            yield delta
+    except LLMError as e:
+        logging.warning("LLM call failed: %s", e)
+        yield f"Error calling LLM: {e}"
+
+def _chat_update(messages, done=False):
+    return (
+        gr.update(value=messages),
+        messages,
+        gr.update(visible=True) if done else gr.update(),
+    )
 
-def chat_submit(documents, images, models, message, history):
+async def chat_submit(documents, images, models, message, history):
+    messages = history or []
+    prior = list(messages)
+    messages.append({"role": "user", "content": message or ""})
+    reply = {"role": "assistant", "content": ""}
+    messages.append(reply)
+    yield _chat_update(messages)
     try:
         if _use_mcp_first():
-            assistant_reply = run_tools_and_draw(documents, message)
+            reply["content"] = await arun_tools_and_draw(documents, message)
         else:
-            state = run_agent(documents, images, models, message, history)
-            assistant_reply = state.get("reply", "")
-        messages = history or []
-        messages.append({"role": "user", "content": message or ""})
-        messages.append({"role": "assistant", "content": assistant_reply})
-        return (
-            gr.update(value=messages),
-            messages,
-            gr.update(visible=True),
-        )
+            state = await arun_agent(documents, images, models, message, prior)
+            reply["content"] = state.get("reply", "")
     except Exception:
         logging.exception("Unexpected error in chat_submit")
-        messages = history or []
-        messages.append({"role": "user", "content": message or ""})
         if _use_mcp_first():
-            assistant_reply = "Tool execution failed. Please verify MCP servers configuration and try again."
+            reply["content"] = "Tool execution failed. Please verify MCP servers configuration and try again."
         else:
-            assistant_reply = run_llm(documents, images, models, message, history, timeout=30)
-            if ("Error:" in assistant_reply) or ("Cannot call model" in assistant_reply):
-                assistant_reply = run_tools_and_draw(documents, message)
-        messages.append({"role": "assistant", "content": assistant_reply})
-        return (
-            gr.update(value=messages),
-            messages,
-            gr.update(visible=True),
-        )
+            reply["content"] = ""
+            async for delta in arun_llm_stream(documents, images, models, message, prior):
+                reply["content"] += delta
+                yield _chat_update(messages)
+            if reply["content"].startswith("Error") or ("Cannot call model" in reply["content"]):
+                reply["content"] = await arun_tools_and_draw(documents, message)
+    yield _chat_update(messages, done=True)
 
 def set_processing():
     return gr.update(value="Processing...", interactive=False), gr.update(visible=True)
@@ -128,5 +155,8 @@ with gr.Blocks(title="AI Architecture Chat", css=CUSTOM_CSS) as agentDesign:
     stop_btn.click(fn=reset_processing, inputs=None, outputs=[send_btn, stop_btn], cancels=[run_click, run_submit])
 
 if __name__ == "__main__":
-    agentDesign.queue()
+    # Warm the preflight cache so the first chat turn does not wait on provider checks
+    preflight(["openai:", "anthropic:", "gemini:"])
+    # Requests write to separate artifact namespaces, so several chat turns can run at once
+    agentDesign.queue(default_concurrency_limit=max(1, env_int("APP_CONCURRENCY", 4)))
     agentDesign.launch()
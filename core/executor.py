@@ -1,74 +1,300 @@
 import os
+import time
+import heapq
+import asyncio
+import logging
+import threading
+import concurrent.futures
+from collections import deque
 from tools.parsers import parse_any
 from tools.specs_builder import build_specs_md
 from core.orchestrator import Orchestrator
-from tools import mcp_client
+from tools import aio, mcp_client
+from tools.artifacts import get_store
+from tools.env import env_int
+from tools.retrieval import warm_index, retrieval_enabled
 
-def _toposort(steps):
+def _max_workers():
+    return max(1, env_int("EXECUTOR_MAX_WORKERS", 4))
+
+def _kahn(steps):
+    # Kahn's algorithm: O(V + E); ties keep the planner's step order. None on cycles or duplicate ids.
     by_id = {s["id"]: s for s in steps}
-    incoming = {sid: set(s.get("depends_on") or []) for sid, s in by_id.items()}
-    ready = [sid for sid, deps in incoming.items() if not deps]
+    if len(by_id) != len(steps):
+        return None
+    indegree = {sid: 0 for sid in by_id}
+    children = {sid: [] for sid in by_id}
+    for sid, s in by_id.items():
+        for d in set(s.get("depends_on") or []):
+            if d in by_id:
+                indegree[sid] += 1
+                children[d].append(sid)
+    ready = deque(sid for sid in by_id if indegree[sid] == 0)
     order = []
     while ready:
-        sid = ready.pop()
+        sid = ready.popleft()
         order.append(by_id[sid])
-        for tid, deps in incoming.items():
-            if sid in deps:
-                deps.remove(sid)
-                if not deps:
-                    ready.append(tid)
-    if len(order) != len(steps):
-        # cycle or unresolved deps; fall back to given order
-        return steps
-    return order
-
-def execute(plan, documents, images, message):
-    state = {"docs": None, "specs": None, "images": [], "texts": [], "reply": None, "logs": []}
-    steps = plan.get("steps", [])
-    for step in _toposort(steps):
+        for tid in children[sid]:
+            indegree[tid] -= 1
+            if indegree[tid] == 0:
+                ready.append(tid)
+    return order if len(order) == len(steps) else None
+
+def _toposort(steps):
+    order = _kahn(steps)
+    # cycle or unresolved deps; fall back to given order
+    return order if order is not None else steps
+
+def _reply_last(steps):
+    # reply renders everything the plan produced, so it waits for every other step, declared or not
+    others = [s.get("id") for s in steps if s.get("action") != "reply"]
+    return [dict(s, depends_on=list(s.get("depends_on") or []) + others) if s.get("action") == "reply" else s for s in steps]
+
+def _schedule(steps):
+    """Topological order plus, per position, the positions it depends on."""
+    steps = _reply_last(steps)
+    order = _kahn(steps)
+    if order is None:
+        # Unschedulable graph: run strictly in the given order
+        return list(steps), {i: ([i - 1] if i else []) for i in range(len(steps))}
+    pos = {s["id"]: i for i, s in enumerate(order)}
+    return order, {i: sorted({pos[d] for d in (s.get("depends_on") or []) if d in pos}) for i, s in enumerate(order)}
+
+def _ingest(documents):
+    # Budgeted extraction (DOC_EXTRACT_MAX_CHARS), shared with every other parse_any caller through the parse cache
+    docs = parse_any(documents or [])
+    if retrieval_enabled() and documents:
+        # The full-text index needs a full extraction: build it off the plan's critical path
+        warm_index(documents)
+    return docs
+
+def _gen_all(documents, message, docs, specs, workdir):
+    orch = Orchestrator(workdir)
+    return orch.run(documents, message, docs=docs, specs_md=specs)
+
+async def _agen_all(documents, message, docs, specs, workdir):
+    orch = Orchestrator(workdir)
+    return await orch.arun(documents, message, docs=docs, specs_md=specs)
+
+class Speculation:
+    """The default ingest -> specs -> gen_all chain, started while the plan is still being made.
+
+    execute() adopts a speculative result when the validated plan has the same action with
+    default args; anything not adopted is cancelled (or left unused if already running).
+    """
+
+    def __init__(self, documents, message, workdir):
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="speculate")
+        # One worker runs the chain in submission order, so each stage can wait on the previous one
+        docs = pool.submit(_ingest, documents)
+        specs = pool.submit(lambda: build_specs_md(docs.result(), message or ""))
+        gen = pool.submit(lambda: _gen_all(documents, message, docs.result(), specs.result(), workdir))
+        pool.shutdown(wait=False)
+        self.futures = {"ingest_docs": docs, "build_specs": specs, "gen_all": gen}
+        self.adopted = set()
+
+    def take(self, step):
+        """(True, result) when step can use the speculative result, else (False, None)."""
         action = step.get("action")
-        sid = step.get("id")
-        state["logs"].append(f"Executing step {sid}:{action}")
+        fut = self.futures.get(action)
+        if fut is None or step.get("args") or action in self.adopted:
+            return False, None
+        try:
+            result = fut.result()
+        except Exception as e:
+            logging.info("Speculative %s unusable: %s", action, e)
+            return False, None
+        self.adopted.add(action)
+        if action == "build_specs":
+            return True, (self.futures["ingest_docs"].result(), result)
+        return True, result
+
+    def discard(self):
+        """Cancel what was not adopted; returns the discarded actions."""
+        dropped = []
+        for action, fut in self.futures.items():
+            if action not in self.adopted:
+                fut.cancel()
+                dropped.append(action)
+        return dropped
+
+def _reply_text(state):
+    text = "Generated files:\n" + "\n".join(state.get("images", []))
+    if state.get("texts"):
+        text += "\n\n" + "\n\n".join(state["texts"])
+    return text
+
+def _adopt(step, state, lock, speculation):
+    hit, value = speculation.take(step)
+    if not hit:
+        return False
+    action = step.get("action")
+    with lock:
         if action == "ingest_docs":
-            state["docs"] = parse_any(documents or [])
+            state["docs"] = value
         elif action == "build_specs":
-            if state.get("docs") is None:
-                state["docs"] = parse_any(documents or [])
-            state["specs"] = build_specs_md(state["docs"], message or "")
+            state["docs"], state["specs"] = value
         elif action == "gen_all":
-            orch = Orchestrator(os.path.join(os.getcwd(), "outputs"))
-            out = orch.run(documents, message)
-            state["images"] = out.get("images", [])
-            state["texts"] = out.get("texts", [])
-        elif action == "mcp_tool":
-            args = step.get("args", {}) or {}
-            server_cmd = args.get("server_cmd") or os.environ.get("MCP_SERVER_CMD")
-            tool = args.get("tool")
-            params = args.get("params") or {}
-            if not server_cmd or not tool:
+            state["images"].extend(value.get("images", []))
+            state["texts"].extend(value.get("texts", []))
+        state["logs"].append(f"adopted speculative {action}")
+    return True
+
+async def _arun_step(step, state, lock, documents, message, workdir, speculation=None):
+    """Run one step into state; returns an error message for a non-fatal failure, else None."""
+    action = step.get("action")
+    # take() waits on the speculative thread, so adoption is checked off the event loop
+    if speculation is not None and await asyncio.to_thread(_adopt, step, state, lock, speculation):
+        return
+    if action == "ingest_docs":
+        docs = await asyncio.to_thread(_ingest, documents)
+        with lock:
+            state["docs"] = docs
+    elif action == "build_specs":
+        with lock:
+            docs = state.get("docs")
+        if docs is None:
+            docs = await asyncio.to_thread(_ingest, documents)
+        specs = await asyncio.to_thread(build_specs_md, docs, message or "")
+        with lock:
+            state["docs"] = docs
+            state["specs"] = specs
+    elif action == "gen_all":
+        with lock:
+            docs, specs = state.get("docs"), state.get("specs")
+        out = await _agen_all(documents, message, docs, specs, workdir)
+        with lock:
+            state["images"].extend(out.get("images", []))
+            state["texts"].extend(out.get("texts", []))
+    elif action == "mcp_tool":
+        args = step.get("args", {}) or {}
+        server_cmd = args.get("server_cmd") or os.environ.get("MCP_SERVER_CMD")
+        tool = args.get("tool")
+        params = args.get("params") or {}
+        if not server_cmd or not tool:
+            with lock:
                 state["logs"].append("mcp_tool skipped: server_cmd or tool missing")
-            else:
+            return
+        res = await mcp_client.call_tool_async(server_cmd, tool, params, timeout=30)
+        if isinstance(res, dict) and res.get("error"):
+            # Tool errors are reported, not fatal: the steps after it still run
+            return f"mcp_tool {tool} error: {res['error']}"
+        with lock:
+            if isinstance(res, dict) and res.get("image_path"):
+                state["images"].append(res["image_path"])
+            if isinstance(res, dict) and res.get("text"):
+                state["texts"].append(res["text"])
+            elif isinstance(res, str):
+                state["texts"].append(res)
+            state["logs"].append(f"mcp_tool {tool} OK")
+    elif action == "reply":
+        text = step.get("args", {}).get("text")
+        with lock:
+            state["reply"] = text or _reply_text(state)
+
+def execute(plan, documents, images, message, max_workers=None, speculation=None, workdir=None):
+    return aio.run(aexecute(plan, documents, images, message, max_workers, speculation, workdir))
+
+async def aexecute(plan, documents, images, message, max_workers=None, speculation=None, workdir=None):
+    """Run the plan's steps as asyncio tasks, at most max_workers at a time, in dependency order.
+
+    When a step fails its downstream steps are cancelled, the rest of the plan finishes, and then
+    RuntimeError is raised so callers can fall back. Files are written to workdir; without one, a request namespace is opened in the artifact store
+    and closed when the plan finishes.
+    """
+    if workdir is not None:
+        return await _arun_plan(plan, documents, message, max_workers, speculation, workdir)
+    store = get_store()
+    workdir = store.open_request()
+    try:
+        return await _arun_plan(plan, documents, message, max_workers, speculation, workdir)
+    finally:
+        await asyncio.to_thread(store.close_request, workdir)
+
+async def _arun_plan(plan, documents, message, max_workers, speculation, workdir):
+    state = {"docs": None, "specs": None, "images": [], "texts": [], "reply": None, "logs": [], "timeline": [], "workdir": workdir}
+    meta = plan.get("meta") or {}
+    if meta:
+        state["plan_meta"] = meta
+        state["logs"].append(f"plan {meta.get('path')} planning_ms={meta.get('planning_ms')}")
+    steps = plan.get("steps", [])
+    order, deps = _schedule(steps)
+    max_workers = max(1, max_workers or _max_workers())
+    lock = threading.Lock()
+
+    # Steps are addressed by topological position so ties always resolve in plan order
+    children = {i: [] for i in deps}
+    waiting = {}
+    for i, ds in deps.items():
+        waiting[i] = set(ds)
+        for d in ds:
+            children[d].append(i)
+    ready = [i for i in sorted(deps) if not waiting[i]]
+    heapq.heapify(ready)
+    status = {}
+    t0 = time.perf_counter()
+
+    async def timed(i):
+        start = time.perf_counter() - t0
+        err = await _arun_step(order[i], state, lock, documents, message, workdir, speculation)
+        return start, err
+
+    def record(i, result, start, end, err=None):
+        step = order[i]
+        status[i] = result
+        with lock:
+            state["timeline"].append({"id": step.get("id"), "action": step.get("action"), "status": result, "start": round(start, 3), "end": round(end, 3)})
+            line = f"step {step.get('id')}:{step.get('action')} {result} start=+{start:.3f}s end=+{end:.3f}s"
+            state["logs"].append(line + (f" ({err})" if err else ""))
+
+    def cancel_downstream(i):
+        queue = deque(children[i])
+        while queue:
+            c = queue.popleft()
+            if c in status:
+                continue
+            now = time.perf_counter() - t0
+            record(c, "cancelled", now, now, f"upstream step {order[i].get('id')} failed")
+            queue.extend(children[c])
+
+    running = {}
+    failures = []
+    try:
+        while ready or running:
+            while ready and len(running) < max_workers:
+                i = heapq.heappop(ready)
+                with lock:
+                    state["logs"].append(f"Executing step {order[i].get('id')}:{order[i].get('action')}")
+                running[asyncio.ensure_future(timed(i))] = (i, time.perf_counter() - t0)
+            done, _ = await asyncio.wait(list(running), return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                i, submitted = running.pop(task)
+                end = time.perf_counter() - t0
                 try:
-                    res = mcp_client.call_tool(server_cmd, tool, params, timeout=30)
-                    if isinstance(res, dict) and res.get("image_path"):
-                        state["images"].append(res["image_path"])
-                    if isinstance(res, dict) and res.get("text"):
-                        state["texts"].append(res["text"])
-                    elif isinstance(res, str):
-                        state["texts"].append(res)
-                    state["logs"].append(f"mcp_tool {tool} OK")
+                    start, err = task.result()
                 except Exception as e:
-                    state["logs"].append(f"mcp_tool error: {e}")
-        elif action == "reply":
-            text = step.get("args", {}).get("text")
-            if not text:
-                text = "Generated files:\n" + "\n".join(state.get("images", []))
-                if state.get("texts"):
-                    text += "\n\n" + "\n\n".join(state["texts"])
-            state["reply"] = text
+                    logging.warning("Step %s:%s failed: %s", order[i].get("id"), order[i].get("action"), e)
+                    record(i, "failed", submitted, end, e)
+                    failures.append((order[i], e))
+                    cancel_downstream(i)
+                    continue
+                record(i, "error" if err else "ok", start, end, err)
+                for c in children[i]:
+                    waiting[c].discard(i)
+                    if not waiting[c] and c not in status:
+                        heapq.heappush(ready, c)
+    finally:
+        # Only reached with tasks left when the caller is cancelled
+        for task in running:
+            task.cancel()
+    if speculation is not None:
+        dropped = speculation.discard()
+        if dropped:
+            state["logs"].append("discarded speculative " + ", ".join(dropped))
+    if failures:
+        # Independent branches have drained; surface the first failure so callers can fall back
+        step, err = failures[0]
+        raise RuntimeError(f"step {step.get('id')}:{step.get('action')} failed: {err}") from err
     if not state.get("reply"):
-        text = "Generated files:\n" + "\n".join(state.get("images", []))
-        if state.get("texts"):
-            text += "\n\n" + "\n\n".join(state["texts"])
-        state["reply"] = text
+        state["reply"] = _reply_text(state)
     return state
@@ -1,14 +1,26 @@
 import os
+import time
+import asyncio
+import logging
 from agents.architecture_agent import ArchitectureAgent
 from agents.uml_agent import UmlAgent
 from agents.topology_agent import TopologyAgent
 from tools.parsers import parse_any
 from tools.specs_builder import build_specs_md
+from tools import aio
+from tools.env import env_flag, env_float, env_int
+
+def _specs_for(documents, prompt, docs):
+    data = docs if docs is not None else parse_any(documents or [])
+    return build_specs_md(data, prompt or "")
 
 class Orchestrator:
-    def __init__(self, workdir):
+    def __init__(self, workdir, concurrent=None, max_workers=None, agent_timeout=None):
         self.workdir = workdir
-        self.arch = ArchitectureAgent(workdir)
+        self.concurrent = env_flag("ORCH_CONCURRENT", False) if concurrent is None else concurrent
+        self.max_workers = max(1, max_workers or env_int("ORCH_MAX_WORKERS", 3))
+        self.agent_timeout = agent_timeout if agent_timeout is not None else env_float("ORCH_AGENT_TIMEOUT", 120.0)
+        self.arch = ArchitectureAgent(workdir, max_workers=self.max_workers if self.concurrent else 1)
         self.uml = UmlAgent(workdir)
         self.topo = TopologyAgent(workdir)
 
@@ -24,18 +36,48 @@ class Orchestrator:
     def detect_uml(self, text):
         return ["class", "sequence", "deployment"]
 
-    def run(self, documents, prompt):
+    def run(self, documents, prompt, docs=None, specs_md=None):
+        # docs/specs_md let callers that already ingested the uploads (the executor) pass them through
+        return aio.run(self.arun(documents, prompt, docs, specs_md))
+
+    async def arun(self, documents, prompt, docs=None, specs_md=None):
         os.makedirs(self.workdir, exist_ok=True)
-        data = parse_any(documents or [])
-        specs_md = build_specs_md(data, prompt or "")
+        if specs_md is None:
+            specs_md = await asyncio.to_thread(_specs_for, documents, prompt, docs)
         context = {"data": {"spec_text": specs_md, "prompt": prompt or ""}, "prefs": {"providers": self.detect_providers(prompt or ""), "uml_types": self.detect_uml(prompt or "")}}
-        arch_outputs = self.arch.run(context)
-        uml_outputs = self.uml.run(context)
-        topo_outputs = self.topo.run(context)
-        texts = []
-        for t in arch_outputs.get("texts", []): texts.append(t)
-        for t in uml_outputs.get("texts", []): texts.append(t)
-        for t in topo_outputs.get("texts", []): texts.append(t)
-        images = arch_outputs.get("images", []) + uml_outputs.get("images", []) + topo_outputs.get("images", [])
-        return {"specs_md": specs_md, "images": images, "texts": texts}
+        agents = [("architecture", self.arch), ("uml", self.uml), ("topology", self.topo)]
+        outputs, timings, errors = {}, {}, {}
+        sem = asyncio.Semaphore(self.max_workers)
 
+        async def timed(name, agent):
+            t0 = time.perf_counter()
+            try:
+                if not self.concurrent:
+                    outputs[name] = await agent.arun(context)
+                    return
+                async with sem:
+                    outputs[name] = await asyncio.wait_for(agent.arun(context), self.agent_timeout)
+            except asyncio.TimeoutError:
+                errors[name] = f"timed out after {self.agent_timeout}s"
+                logging.warning("Agent %s timed out after %ss", name, self.agent_timeout)
+            except Exception as e:
+                # One failing agent must not discard the others' outputs
+                errors[name] = f"{type(e).__name__}: {e}"
+                logging.warning("Agent %s failed: %s", name, e)
+            finally:
+                timings[name] = round(time.perf_counter() - t0, 3)
+
+        if self.concurrent:
+            await asyncio.gather(*(timed(name, agent) for name, agent in agents))
+        else:
+            for name, agent in agents:
+                await timed(name, agent)
+        # Merge in fixed agent order regardless of completion order
+        texts = []
+        images = []
+        for name, _ in agents:
+            out = outputs.get(name) or {}
+            texts.extend(out.get("texts", []))
+            images.extend(out.get("images", []))
+        timings = {name: timings[name] for name, _ in agents if name in timings}
+        return {"specs_md": specs_md, "images": images, "texts": texts, "timings": timings, "errors": errors}
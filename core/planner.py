@@ -1,7 +1,12 @@
 
 
+import re
 import json
-from tools.llm_router import route
+import time
+import logging
+from tools import aio
+from tools.env import env_flag
+from tools.llm_router import aroute, LLMError
 
 PLANNING_SYSTEM = (
     "You are a planning agent. Return ONLY JSON following this schema (no prose):\n"
@@ -16,15 +21,77 @@ def _coerce_list(x):
         return []
     return [x]
 
+# Prompts that ask for external tools or change the default flow still go to the LLM planner.
+# Only explicit plan modifiers count: words like "server", "then" or "first" are ordinary prompt text.
+_ARTIFACT = r"(diagrams?|specs?(\.md)?|uml|topology|architecture|mermaid|plantuml)"
+_NEEDS_LLM = re.compile(
+    r"\bmcp\b|\b(use|call|invoke|run)\s+(the\s+|an?\s+)?[\w-]+\s+tools?\b|\btool\s+calls?\b"
+    rf"|\b(without|skip|skipping|omit|exclude|no)\s+(the\s+|any\s+)?{_ARTIFACT}\b"
+    rf"|\b(only|just)\s+(the\s+|an?\s+)?{_ARTIFACT}\b|\b{_ARTIFACT}\s+only\b"
+    r"|\b(don'?t|do\s+not)\s+(generate|draw|build|create|render)\b"
+    r"|\b(search|look\s*up|fetch)\s+(the\s+)?(aws\s+)?(docs|documentation)\b",
+    re.IGNORECASE,
+)
+
+def _fast_path_enabled():
+    return env_flag("PLANNER_FAST_PATH", True)
+
+def classify_intent(message):
+    """'default' when the standard ingest -> specs -> diagrams -> reply chain fits, else 'llm'.
+
+    >>> classify_intent("draw the server architecture for an AWS web app")
+    'default'
+    >>> classify_intent("first put an ALB in front, then call the API only through CloudFront")
+    'default'
+    >>> classify_intent("use the MCP diagram server")
+    'llm'
+    >>> classify_intent("skip specs and give me only the UML")
+    'llm'
+    >>> classify_intent("search the AWS documentation for VPC best practices")
+    'llm'
+    """
+    text = (message or "").strip()
+    if len(text) > 600 or _NEEDS_LLM.search(text):
+        return "llm"
+    return "default"
+
+def needs_llm(message):
+    """Whether make_plan will call the LLM for this prompt."""
+    return not _fast_path_enabled() or classify_intent(message) == "llm"
+
+def default_plan(reply_text=None):
+    reply_args = {"text": reply_text} if reply_text else {}
+    return {
+        "steps": [
+            {"id": 1, "action": "ingest_docs", "args": {}, "depends_on": []},
+            {"id": 2, "action": "build_specs", "args": {}, "depends_on": [1]},
+            {"id": 3, "action": "gen_all", "args": {}, "depends_on": [2]},
+            {"id": 4, "action": "reply", "args": reply_args, "depends_on": [3]},
+        ]
+    }
+
+def _with_meta(plan, path, t0, intent):
+    ms = round((time.perf_counter() - t0) * 1000, 1)
+    logging.info("Planned via %s path in %.1f ms", path, ms)
+    plan["meta"] = {"path": path, "intent": intent, "planning_ms": ms}
+    return plan
+
 def make_plan(models, documents, images, message, history):
+    return aio.run(amake_plan(models, documents, images, message, history))
+
+async def amake_plan(models, documents, images, message, history):
+    t0 = time.perf_counter()
+    intent = "llm" if needs_llm(message) else "default"
+    if intent == "default":
+        return _with_meta(default_plan(), "fast", t0, intent)
     msgs = [
         {"role": "system", "content": PLANNING_SYSTEM},
         {"role": "user", "content": message or ""},
     ]
     model_list = _coerce_list(models)
-    # Cost optimization: planning does not require full document context
-    out = route(model_list, documents, msgs, images, include_docs=False)
     try:
+        # Cost optimization: planning does not require full document context
+        out = await aroute(model_list, documents, msgs, images, include_docs=False, temperature=0)
         obj = json.loads(out)
         if isinstance(obj, dict) and isinstance(obj.get("steps", []), list):
             # Normalize fields
@@ -39,15 +106,10 @@ def make_plan(models, documents, images, message, history):
                     "depends_on": [int(d) for d in (s.get("depends_on") or []) if isinstance(d, (int, str))],
                 }
                 norm.append(step)
-            return {"steps": norm}
+            return _with_meta({"steps": norm}, "llm", t0, intent)
+    except LLMError as e:
+        logging.warning("Planner LLM unavailable, using default plan: %s", e)
     except Exception:
         pass
     # Safe default plan with explicit IDs and dependencies
-    return {
-        "steps": [
-            {"id": 1, "action": "ingest_docs", "args": {}, "depends_on": []},
-            {"id": 2, "action": "build_specs", "args": {}, "depends_on": [1]},
-            {"id": 3, "action": "gen_all", "args": {}, "depends_on": [2]},
-            {"id": 4, "action": "reply", "args": {"text": "Generated architecture artifacts from documents."}, "depends_on": [3]},
-        ]
-    }
+    return _with_meta(default_plan("Generated architecture artifacts from documents."), "fallback", t0, intent)
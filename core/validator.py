@@ -64,4 +64,7 @@ def validate_plan(plan):
             {"id": 4, "action": "reply", "args": {"text": "Generated outputs."}, "depends_on": [3]},
         ]
 
-    return {"steps": steps}
+    out = {"steps": steps}
+    if isinstance((plan or {}).get("meta"), dict):
+        out["meta"] = dict(plan["meta"])
+    return out
@@ -0,0 +1,74 @@
+import asyncio
+import threading
+import concurrent.futures
+from typing import Any, AsyncIterator, Awaitable, Iterator
+
+# One background event loop for the async pipeline: LLM provider calls, HTTP rendering and
+# MCP sessions all live here, so async clients and sessions are never shared across loops.
+_loop: asyncio.AbstractEventLoop | None = None
+_thread: threading.Thread | None = None
+_lock = threading.Lock()
+
+def _run_loop(loop: asyncio.AbstractEventLoop) -> None:
+    asyncio.set_event_loop(loop)
+    loop.run_forever()
+
+def get_loop() -> asyncio.AbstractEventLoop:
+    global _loop, _thread
+    with _lock:
+        if _loop is None or _thread is None or not _thread.is_alive():
+            _loop = asyncio.new_event_loop()
+            _thread = threading.Thread(target=_run_loop, args=(_loop,), name="aio-loop", daemon=True)
+            _thread.start()
+        return _loop
+
+def in_loop_thread() -> bool:
+    return _thread is not None and threading.current_thread() is _thread
+
+def run(coro: Awaitable[Any], timeout: float | None = None) -> Any:
+    """Run a coroutine on the shared loop and block the calling (non-loop) thread for its result."""
+    if in_loop_thread():
+        coro.close()
+        raise RuntimeError("blocking call on the shared event loop; await the async variant instead")
+    fut = asyncio.run_coroutine_threadsafe(coro, get_loop())
+    try:
+        return fut.result(timeout)
+    except concurrent.futures.TimeoutError:
+        fut.cancel()
+        raise TimeoutError(f"task timed out after {timeout}s")
+
+async def on_loop(coro: Awaitable[Any]) -> Any:
+    """Await a coroutine on the shared loop from any event loop, without blocking a thread."""
+    loop = get_loop()
+    if asyncio.get_running_loop() is loop:
+        return await coro
+    fut = asyncio.run_coroutine_threadsafe(coro, loop)
+    try:
+        return await asyncio.wrap_future(fut)
+    except asyncio.CancelledError:
+        fut.cancel()
+        raise
+
+async def aiterate(agen: AsyncIterator[Any]) -> AsyncIterator[Any]:
+    """Re-yield an async generator that runs on the shared loop into the caller's loop."""
+    try:
+        while True:
+            try:
+                item = await on_loop(agen.__anext__())
+            except StopAsyncIteration:
+                return
+            yield item
+    finally:
+        await on_loop(agen.aclose())
+
+def iterate(agen: AsyncIterator[Any]) -> Iterator[Any]:
+    """Sync iterator over an async generator that runs on the shared loop."""
+    try:
+        while True:
+            try:
+                item = run(agen.__anext__())
+            except StopAsyncIteration:
+                return
+            yield item
+    finally:
+        run(agen.aclose())
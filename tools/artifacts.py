@@ -0,0 +1,192 @@
+import os
+import time
+import uuid
+import shutil
+import logging
+import threading
+from typing import Any, Dict
+from .cache import file_digest, link_or_copy
+from .env import env_float
+
+class ArtifactStore:
+    """Per-request output directories backed by content-addressed blobs.
+
+    Each request writes into its own directory under requests/, so concurrent requests never
+    overwrite each other's fixed file names (arch_aws.png, uml_class.png, ...). When a request
+    closes, its files are interned: hard-linked to blobs/<sha256><ext>, replacing duplicates by a
+    link to the existing blob. A blob's link count is its reference count, so a blob left with a
+    single link is unreferenced. gc() drops requests past ttl seconds, then the oldest ones while
+    the store is over max_bytes, then unreferenced blobs. Open requests, and requests closed less
+    than min_age seconds ago, are never collected, so a reply's file paths stay valid.
+    """
+
+    def __init__(self, root: str, max_bytes: int = 1024 * 1024 * 1024, ttl: float | None = 86400, gc_interval: float = 300,
+                 min_age: float = 600):
+        self.root = root
+        self.blob_dir = os.path.join(root, "blobs")
+        self.request_dir = os.path.join(root, "requests")
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.gc_interval = gc_interval
+        self.min_age = min_age
+        self._lock = threading.Lock()
+        self._active = set()
+        self._gc_at = 0.0
+        self._gc_thread = None
+
+    def open_request(self) -> str:
+        """Create a fresh namespace directory for one request and return its path."""
+        path = os.path.join(self.request_dir, time.strftime("%Y%m%d-%H%M%S-") + uuid.uuid4().hex[:8])
+        os.makedirs(path, exist_ok=True)
+        with self._lock:
+            self._active.add(path)
+        return path
+
+    def close_request(self, path: str) -> None:
+        """Intern the request's files into the blob store; paths handed out stay valid."""
+        try:
+            for dirpath, _, files in os.walk(path):
+                for f in files:
+                    if not f.endswith(".tmp"):
+                        self._intern(os.path.join(dirpath, f))
+        except Exception:
+            logging.exception("Could not intern artifacts in %s", path)
+        finally:
+            try:
+                # Marks when the request closed; gc() measures the grace period from here
+                os.utime(path)
+            except OSError:
+                pass
+            with self._lock:
+                self._active.discard(path)
+                due = time.monotonic() - self._gc_at >= self.gc_interval and not (self._gc_thread and self._gc_thread.is_alive())
+                if due:
+                    self._gc_at = time.monotonic()
+                    # Collection walks the whole store; keep it off the request path
+                    self._gc_thread = threading.Thread(target=self._gc_quietly, name="artifact-gc", daemon=True)
+                    self._gc_thread.start()
+
+    def _gc_quietly(self) -> None:
+        try:
+            self.gc()
+        except Exception:
+            logging.exception("Artifact GC failed")
+
+    def _intern(self, path: str) -> None:
+        digest = file_digest(path)
+        blob = os.path.join(self.blob_dir, digest[:2], digest + os.path.splitext(path)[1].lower())
+        if os.path.exists(blob):
+            if not os.path.samefile(blob, path):
+                link_or_copy(blob, path)
+            return
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+        try:
+            os.link(path, blob)
+        except FileExistsError:
+            # Another request interned the same content first
+            link_or_copy(blob, path)
+        except OSError:
+            # No hard links on this filesystem: keep the request's own copy, without dedup
+            pass
+
+    def _walk(self, top: str):
+        for dirpath, _, files in os.walk(top):
+            for f in files:
+                try:
+                    yield os.path.join(dirpath, f), os.stat(os.path.join(dirpath, f))
+                except OSError:
+                    continue
+
+    def usage(self) -> int:
+        """Bytes referenced by requests, counting each hard-linked file once.
+
+        Unreferenced blobs are left out: gc() removes them, and the ones still linked from the
+        render cache are bounded by that cache's own quota.
+        """
+        seen = set()
+        total = 0
+        for _, st in self._walk(self.request_dir):
+            if (st.st_dev, st.st_ino) not in seen:
+                seen.add((st.st_dev, st.st_ino))
+                total += st.st_size
+        return total
+
+    def _drop(self, path: str) -> int:
+        # Bytes freed: files held only by this request, or by it and one blob link
+        freed = sum(st.st_size for _, st in self._walk(path) if st.st_nlink <= 2)
+        shutil.rmtree(path, ignore_errors=True)
+        return freed
+
+    def gc(self) -> Dict[str, int]:
+        now = time.time()
+        with self._lock:
+            active = set(self._active)
+        try:
+            names = os.listdir(self.request_dir)
+        except FileNotFoundError:
+            names = []
+        requests = []
+        for name in names:
+            p = os.path.join(self.request_dir, name)
+            try:
+                requests.append((os.stat(p).st_mtime, p))
+            except OSError:
+                continue
+        requests.sort()
+        expired = quota = 0
+        kept = []
+        for mtime, p in requests:
+            if p in active or now - mtime < self.min_age:
+                continue
+            if self.ttl and now - mtime > self.ttl:
+                self._drop(p)
+                expired += 1
+            else:
+                kept.append(p)
+        used = self.usage()
+        for p in kept:
+            if used <= self.max_bytes:
+                break
+            used -= self._drop(p)
+            quota += 1
+        blobs = 0
+        for path, st in list(self._walk(self.blob_dir)):
+            if st.st_nlink <= 1:
+                try:
+                    os.remove(path)
+                    blobs += 1
+                except OSError:
+                    pass
+        if expired or quota or blobs:
+            logging.info("Artifact GC: %d expired, %d over quota, %d blobs removed", expired, quota, blobs)
+        return {"expired": expired, "over_quota": quota, "blobs_removed": blobs}
+
+    def stats(self) -> Dict[str, Any]:
+        logical = sum(st.st_size for _, st in self._walk(self.request_dir))
+        try:
+            requests = len(os.listdir(self.request_dir))
+        except FileNotFoundError:
+            requests = 0
+        with self._lock:
+            active = len(self._active)
+        return {"requests": requests, "active": active, "blobs": sum(1 for _ in self._walk(self.blob_dir)),
+                "bytes": self.usage(), "logical_bytes": logical}
+
+_store: ArtifactStore | None = None
+_store_lock = threading.Lock()
+
+def get_store() -> ArtifactStore:
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = ArtifactStore(
+                os.environ.get("ARTIFACT_DIR") or os.path.join(os.getcwd(), "outputs"),
+                max_bytes=int(env_float("ARTIFACT_MAX_MB", 1024) * 1024 * 1024),
+                ttl=env_float("ARTIFACT_TTL", 86400) or None,
+                gc_interval=env_float("ARTIFACT_GC_INTERVAL", 300),
+                min_age=env_float("ARTIFACT_MIN_AGE", 600),
+            )
+        return _store
+
+def artifact_stats() -> Dict[str, Any]:
+    return get_store().stats()
@@ -0,0 +1,244 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict
+
+def cache_root() -> str:
+    return os.environ.get("CACHE_DIR") or os.path.join(os.getcwd(), ".cache")
+
+def sha256_bytes(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+_digest_memo: "OrderedDict[tuple, str]" = OrderedDict()
+_digest_lock = threading.Lock()
+
+def file_digest(path: str) -> str:
+    """sha256 of a file's bytes, memoized on (path, size, mtime) so unchanged files are not re-read."""
+    st = os.stat(path)
+    memo_key = (os.path.abspath(path), st.st_size, st.st_mtime_ns)
+    with _digest_lock:
+        hit = _digest_memo.get(memo_key)
+        if hit:
+            _digest_memo.move_to_end(memo_key)
+            return hit
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    digest = h.hexdigest()
+    with _digest_lock:
+        _digest_memo[memo_key] = digest
+        while len(_digest_memo) > 4096:
+            _digest_memo.popitem(last=False)
+    return digest
+
+def link_or_copy(src: str, dst: str) -> str:
+    """Hard-link src to dst (copy across filesystems); dst is replaced, never written through."""
+    d = os.path.dirname(dst)
+    if d:
+        os.makedirs(d, exist_ok=True)
+    tmp = f"{dst}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        os.link(src, tmp)
+    except OSError:
+        shutil.copyfile(src, tmp)
+    os.replace(tmp, dst)
+    return dst
+
+def write_atomic(path: str, data: bytes) -> str:
+    # Replace rather than truncate: path may be a hard link into a cache or artifact store
+    d = os.path.dirname(path)
+    if d:
+        os.makedirs(d, exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+    return path
+
+def _json_dumps(value: Any) -> bytes:
+    return json.dumps(value, ensure_ascii=False, default=str).encode("utf-8")
+
+def _json_loads(raw: bytes) -> Any:
+    return json.loads(raw.decode("utf-8"))
+
+class ContentCache:
+    """Content-addressed cache with an in-memory LRU tier and an optional size-bounded disk tier.
+
+    Keys are hex digests. Values are serialized with ``dumps``/``loads`` on the disk tier
+    (JSON by default); the memory tier holds the live objects. Disk recency is tracked by mtime.
+    With ``ttl`` set, entries older than ttl seconds are treated as misses and dropped.
+    """
+
+    def __init__(self, name: str, max_items: int = 128, disk_dir: str | None = None,
+                 max_disk_bytes: int = 256 * 1024 * 1024,
+                 dumps: Callable[[Any], bytes] = _json_dumps, loads: Callable[[bytes], Any] = _json_loads,
+                 ttl: float | None = None):
+        self.name = name
+        self.max_items = max_items
+        self.disk_dir = disk_dir
+        self.max_disk_bytes = max_disk_bytes
+        self.dumps = dumps
+        self.loads = loads
+        self.ttl = ttl
+        self._mem: "OrderedDict[str, Any]" = OrderedDict()
+        self._born: Dict[str, float] = {}
+        self._lock = threading.Lock()
+        self._disk_bytes: int | None = None
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expired = 0
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, key[:2], key)
+
+    def disk_path(self, key: str) -> str | None:
+        """Path of the on-disk entry for key, if present."""
+        if not self.disk_dir:
+            return None
+        p = self._path(key)
+        return p if os.path.exists(p) else None
+
+    def get(self, key: str) -> Any:
+        now = time.time()
+        with self._lock:
+            if key in self._mem:
+                if self._stale(self._born.get(key, now), now):
+                    self._forget(key)
+                    self.expired += 1
+                else:
+                    self._mem.move_to_end(key)
+                    self.hits += 1
+                    return self._mem[key]
+        if self.disk_dir:
+            p = self._path(key)
+            try:
+                with open(p, "rb") as f:
+                    raw = f.read()
+                born = now
+                if self.ttl is not None:
+                    # TTL entries carry their creation time on the first line; mtime tracks recency
+                    head, _, raw = raw.partition(b"\n")
+                    born = float(head)
+                if self._stale(born, now):
+                    self._unlink(p)
+                    with self._lock:
+                        self.expired += 1
+                        self.misses += 1
+                    return None
+                value = self.loads(raw)
+                os.utime(p)
+                with self._lock:
+                    self.hits += 1
+                    self.disk_hits += 1
+                    self._remember(key, value, born)
+                return value
+            except FileNotFoundError:
+                pass
+            except Exception:
+                logging.warning("%s cache: dropping unreadable entry %s", self.name, key)
+                self._unlink(p)
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key: str, value: Any) -> None:
+        born = time.time()
+        with self._lock:
+            self._remember(key, value, born)
+        if not self.disk_dir:
+            return
+        try:
+            raw = self.dumps(value)
+            if self.ttl is not None:
+                raw = f"{born:.3f}\n".encode("ascii") + raw
+            write_atomic(self._path(key), raw)
+            with self._lock:
+                if self._disk_bytes is not None:
+                    self._disk_bytes += len(raw)
+            self._trim_disk()
+        except Exception:
+            logging.exception("%s cache: disk write failed", self.name)
+
+    def _stale(self, born: float, now: float) -> bool:
+        return self.ttl is not None and now - born > self.ttl
+
+    def _remember(self, key: str, value: Any, born: float) -> None:
+        self._mem[key] = value
+        self._mem.move_to_end(key)
+        self._born[key] = born
+        while len(self._mem) > self.max_items:
+            old, _ = self._mem.popitem(last=False)
+            self._born.pop(old, None)
+            self.evictions += 1
+
+    def _forget(self, key: str) -> None:
+        self._mem.pop(key, None)
+        self._born.pop(key, None)
+
+    def _unlink(self, p: str) -> None:
+        try:
+            os.remove(p)
+        except OSError:
+            pass
+
+    def _scan_disk(self) -> list[tuple[float, int, str]]:
+        entries = []
+        for dirpath, _, files in os.walk(self.disk_dir):
+            for fn in files:
+                if fn.endswith(".tmp"):
+                    continue
+                p = os.path.join(dirpath, fn)
+                try:
+                    st = os.stat(p)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, p))
+        return entries
+
+    def _trim_disk(self) -> None:
+        with self._lock:
+            if self._disk_bytes is not None and self._disk_bytes <= self.max_disk_bytes:
+                return
+        entries = self._scan_disk()
+        total = sum(e[1] for e in entries)
+        if total > self.max_disk_bytes:
+            # Evict least recently used down to 90% of the quota to avoid rescanning on every put
+            target = int(self.max_disk_bytes * 0.9)
+            for _, size, p in sorted(entries):
+                if total <= target:
+                    break
+                self._unlink(p)
+                total -= size
+                self.evictions += 1
+        with self._lock:
+            self._disk_bytes = total
+
+    def clear(self) -> None:
+        with self._lock:
+            self._mem.clear()
+            self._born.clear()
+            self._disk_bytes = None
+        if self.disk_dir:
+            for _, _, p in self._scan_disk():
+                self._unlink(p)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expired": self.expired,
+                "hit_rate": (self.hits / lookups) if lookups else 0.0,
+                "items": len(self._mem),
+            }
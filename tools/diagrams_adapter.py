@@ -17,7 +17,7 @@ def generate_architecture(provider, data, workdir):
                     "api gateway","sqs","sns","eks","ecs","ecr","kms","iam","cloudwatch",
                     "gce","compute engine","cloud sql","bigquery","pubsub","gke",
                     "cloud storage","cloud run","cloud functions","spanner","memorystore"]:
-            if re.search(rf"\\b{re.escape(word)}\\b", text_hint):
+            if re.search(rf"\b{re.escape(word)}\b", text_hint):
                 svc.append(word)
         name = os.path.join(workdir, f"arch_{provider}")
         if provider == "aws" and os.environ.get("AWS_DIAGRAM_MCP_CMD"):
@@ -36,24 +36,24 @@ def generate_architecture(provider, data, workdir):
             if any("cloudfront" in x for x in svc): chain.append("CloudFront('cdn')")
             if any("route53" in x for x in svc): chain.append("Route53('dns')")
             if any("elb" in x for x in svc) or any('api gateway' in x for x in svc):
-                if any('api gateway' in x for x in svc): chain.append(\"APIGateway('api')\")
-                else: chain.append(\"ELB('lb')\")
-            if any("lambda" in x for x in svc): chain.append(\"Lambda('fn')\")
-            elif any("ecs" in x for x in svc): chain.append(\"ECS('svc')\")
-            elif any("eks" in x for x in svc): chain.append(\"EKS('k8s')\")
-            else: chain.append(\"EC2('app')\")
-            if any("rds" in x for x in svc): chain.append(\"RDS('db')\")
-            elif any("dynamodb" in x for x in svc): chain.append(\"DynamoDB('kv')\")
-            if any("s3" in x for x in svc): chain.append(\"S3('bucket')\")
-            if not chain: chain = [\"ELB('lb')\",\"EC2('app')\",\"RDS('db')\"]
-            code_lines.append(\"    \" + \" >> \".join(chain))
-            code = \"\\n\".join(code_lines)
-            out = name + \".png\"
+                if any('api gateway' in x for x in svc): chain.append("APIGateway('api')")
+                else: chain.append("ELB('lb')")
+            if any("lambda" in x for x in svc): chain.append("Lambda('fn')")
+            elif any("ecs" in x for x in svc): chain.append("ECS('svc')")
+            elif any("eks" in x for x in svc): chain.append("EKS('k8s')")
+            else: chain.append("EC2('app')")
+            if any("rds" in x for x in svc): chain.append("RDS('db')")
+            elif any("dynamodb" in x for x in svc): chain.append("DynamoDB('kv')")
+            if any("s3" in x for x in svc): chain.append("S3('bucket')")
+            if not chain: chain = ["ELB('lb')","EC2('app')","RDS('db')"]
+            code_lines.append("    " + " >> ".join(chain))
+            code = "\n".join(code_lines)
+            out = name + ".png"
             p = mcp_client.aws_diagram_generate(code, out)
             if isinstance(p, str) and os.path.exists(p):
                 return p
-            if isinstance(p, dict) and p.get(\"text\"):
-                txt = p[\"text\"]
+            if isinstance(p, dict) and p.get("text"):
+                txt = p["text"]
                 if isinstance(txt, str) and os.path.exists(out):
                     return out
         if provider in ["aws","gcp"]:
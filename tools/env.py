@@ -0,0 +1,24 @@
+import os
+
+# Settings read from the environment. An unset, blank or malformed value means the default.
+
+_TRUE = ("1", "true", "yes", "on")
+
+def env_str(name: str) -> str:
+    return (os.environ.get(name) or "").strip()
+
+def env_int(name: str, default: int) -> int:
+    try:
+        return int(env_str(name) or default)
+    except ValueError:
+        return default
+
+def env_float(name: str, default: float) -> float:
+    try:
+        return float(env_str(name) or default)
+    except ValueError:
+        return default
+
+def env_flag(name: str, default: bool = False) -> bool:
+    val = env_str(name).lower()
+    return val in _TRUE if val else default
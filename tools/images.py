@@ -0,0 +1,106 @@
+import io
+import os
+import base64
+import logging
+import threading
+from typing import Any, Dict
+from .cache import ContentCache, cache_root, file_digest, sha256_bytes
+from .env import env_flag, env_int
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow is optional; without it images are sent as uploaded
+    Image = None
+
+# Bump when the encoding below changes so cached payloads are rebuilt
+IMAGE_VERSION = "1"
+
+# (max long edge, max short edge) beyond which a provider downsamples anyway
+PROVIDER_LIMITS = {
+    "openai": (2048, 768),
+    "anthropic": (1568, None),
+    "gemini": (3072, None),
+}
+
+_MIME = {".png": "image/png", ".jpg": "image/jpeg", ".jpeg": "image/jpeg", ".webp": "image/webp", ".gif": "image/gif"}
+
+def _enabled():
+    return env_flag("IMAGE_PREPROCESS", True)
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def _get_cache():
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = ContentCache(
+                "image",
+                max_items=env_int("IMAGE_CACHE_ITEMS", 32),
+                disk_dir=os.path.join(cache_root(), "images"),
+                max_disk_bytes=env_int("IMAGE_CACHE_MAX_MB", 128) * 1024 * 1024,
+            )
+        return _cache
+
+def _scale(size, limits):
+    w, h = size
+    long_max, short_max = limits
+    scale = 1.0
+    if long_max:
+        scale = min(scale, long_max / max(w, h))
+    if short_max:
+        scale = min(scale, short_max / min(w, h))
+    return scale
+
+def _encode(raw: bytes, mime: str, limits) -> tuple[bytes, str]:
+    img = Image.open(io.BytesIO(raw))
+    if getattr(img, "is_animated", False):
+        return raw, mime
+    img = ImageOps.exif_transpose(img)
+    scale = _scale(img.size, limits)
+    if scale < 1.0:
+        img = img.resize((max(1, round(img.width * scale)), max(1, round(img.height * scale))), Image.LANCZOS)
+    out = io.BytesIO()
+    if mime == "image/jpeg" or (img.mode in ("RGB", "L") and mime != "image/png"):
+        # Photos: JPEG at a quality well above what the models can tell apart
+        img.convert("RGB").save(out, "JPEG", quality=env_int("IMAGE_JPEG_QUALITY", 85), optimize=True)
+        new_mime = "image/jpeg"
+    else:
+        # Diagrams and screenshots keep lossless PNG so text and lines stay sharp
+        img.save(out, "PNG", optimize=True)
+        new_mime = "image/png"
+    data = out.getvalue()
+    if scale >= 1.0 and len(data) >= len(raw):
+        return raw, mime
+    return data, new_mime
+
+def prepare_image(path: str, family: str = "openai") -> Dict[str, Any]:
+    """Base64 payload for one image, downsized for the provider family and cached by content hash.
+
+    Returns {"data", "mime", "name", "bytes_in", "bytes_out"}; data is None if the file is unreadable.
+    """
+    name = os.path.basename(path)
+    mime = _MIME.get(os.path.splitext(path)[1].lower(), "image/png")
+    limits = PROVIDER_LIMITS.get(family, PROVIDER_LIMITS["openai"])
+    process = _enabled() and Image is not None
+    try:
+        key = sha256_bytes(f"{IMAGE_VERSION}|{process}|{limits}|{env_int('IMAGE_JPEG_QUALITY', 85)}|{file_digest(path)}".encode("utf-8"))
+    except OSError:
+        return {"data": None, "mime": None, "name": name, "bytes_in": 0, "bytes_out": 0}
+    cache = _get_cache()
+    hit = cache.get(key)
+    if hit is None:
+        with open(path, "rb") as f:
+            raw = f.read()
+        data, out_mime = raw, mime
+        if process:
+            try:
+                data, out_mime = _encode(raw, mime, limits)
+            except Exception as e:
+                logging.warning("Image preprocessing failed for %s: %s", name, e)
+        hit = {"data": base64.b64encode(data).decode("ascii"), "mime": out_mime, "bytes_in": len(raw), "bytes_out": len(data)}
+        cache.put(key, hit)
+    return {**hit, "name": name}
+
+def image_cache_stats():
+    return _get_cache().stats()
@@ -1,103 +1,280 @@
 import os
+import re
+import json
+import time
 import logging
+import asyncio
+import threading
 from typing import List, Dict, Any
+from collections import deque
 import base64
 import requests
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI
+from . import aio
+from .env import env_flag, env_float, env_int
+from .llm_stats import get_stats, order_models
+from .images import prepare_image
 
 logging.basicConfig(level=logging.INFO)
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 
-def NB(sv, default):
-    try:
-        return int(os.getenv(sv, str(default)))
-    except Exception:
-        return default
+class LLMError(Exception):
+    """A model call failed; the message is safe to show to users."""
+
+    def __init__(self, message: str, model: str | None = None):
+        super().__init__(message)
+        self.model = model
+
+class LLMConfigError(LLMError):
+    """Unsupported model or missing API key."""
+
+class LLMProviderError(LLMError):
+    """The provider rejected the request, failed, or returned nothing."""
+
+class LLMTimeout(LLMProviderError):
+    """The provider did not answer within its adaptive timeout."""
+
+class LLMCircuitOpen(LLMError):
+    """The provider was skipped because its circuit breaker is open."""
+
+class LLMUnavailable(LLMError):
+    """No selected model produced an answer; errors holds each model's failure."""
 
-def _docs_to_context(documents: List[str]) -> str:
+    def __init__(self, errors: List[LLMError]):
+        detail = "; ".join(f"{e.model}: {e}" for e in errors)
+        super().__init__("Cannot call model. Check model choices and environment API keys." + (f" ({detail})" if detail else ""))
+        self.errors = errors
+
+def _leading_context(documents: List[str]) -> str:
+    from .parsers import parse_any
+    data = parse_any(documents)
+    max_docs = env_int("DOC_CONTEXT_MAX_DOCS", 3)
+    max_chars = env_int("DOC_CONTEXT_MAX_CHARS", 1500)
+    parts = []
+    for k, v in list(data.items())[:max_docs]:
+        if isinstance(v, dict):
+            content = v.get("content", "")[:max_chars]
+            if content:
+                parts.append(f"[{k}] {v.get('file','')}:\n{content}")
+    return "\n\n".join(parts)
+
+def _docs_to_context(documents: List[str], query: str = "", max_chars: int | None = None) -> str:
     try:
-        from .parsers import parse_any
-        data = parse_any(documents)
-        max_docs = NB("DOC_CONTEXT_MAX_DOCS", 3)
-        max_chars = NB("DOC_CONTEXT_MAX_CHARS", 1500)
-        parts = []
-        for k, v in list(data.items())[:max_docs]:
-            if isinstance(v, dict):
-                content = v.get("content", "")[:max_chars]
-                if content:
-                    parts.append(f"[{k}] {v.get('file','')}:\n{content}")
-        total = "\n\n".join(parts)
-        hard_cap = NB("DOC_CONTEXT_TOTAL_CHARS", 6000)
+        hard_cap = env_int("DOC_CONTEXT_TOTAL_CHARS", 6000)
+        if max_chars is not None:
+            hard_cap = min(hard_cap, max_chars)
+        if hard_cap <= 0:
+            return ""
+        total = ""
+        from .retrieval import index_for, retrieval_enabled
+        if query.strip() and retrieval_enabled():
+            # Rank chunks against the prompt; fall back to document heads when nothing matches
+            total = index_for(documents).pack(query, hard_cap)
+        if not total:
+            total = _leading_context(documents)
         return total[:hard_cap]
     except Exception:
         return ""
 
-def _call_openai(model: str, messages: List[Dict[str, str]]) -> str:
-    try:
-        api_key = os.environ.get("OPENAI_API_KEY")
-        if not api_key:
-            return "OPENAI_API_KEY not configured"
-        client = OpenAI(api_key=api_key)
-        resp = client.chat.completions.create(model=model, messages=messages)
-        return resp.choices[0].message.content or ""
-    except Exception as e:
-        return f"OpenAI error: {e}"
+# Rough chars-per-token and per-image token costs by provider family; good enough for budgeting
+_CHARS_PER_TOKEN = {"openai": 4.0, "anthropic": 3.5, "gemini": 4.0}
+_IMAGE_TOKENS = {"openai": 765, "anthropic": 1600, "gemini": 258}
+_MSG_OVERHEAD = 4
 
-def _call_anthropic(model: str, messages: List[Dict[str, str]]) -> str:
-    try:
-        import anthropic
-        api_key = os.environ.get("ANTHROPIC_API_KEY")
-        if not api_key:
-            return "ANTHROPIC_API_KEY not configured"
-        client = anthropic.Anthropic(api_key=api_key)
-        # Convert to Anthropic format: system + user turns
-        system_msg = "" 
-        content = []
-        for m in messages:
-            if m.get("role") == "system":
-                system_msg = m.get("content", "")
-            elif m.get("role") == "user":
-                content.append({"role": "user", "content": m.get("content", "")})
-            elif m.get("role") == "assistant":
-                content.append({"role": "assistant", "content": m.get("content", "")})
-        msg = client.messages.create(model=model, max_tokens=1000, system=system_msg or None, messages=content)
-        return "".join([b.text for b in msg.content if hasattr(b, "text")])
-    except Exception as e:
-        return f"Anthropic error: {e}"
+def _family(model: str) -> str:
+    prefix = (model or "").split(":", 1)[0]
+    return "gemini" if prefix in ("vertex", "google", "gemini") else prefix
 
-def _call_gemini(model: str, messages: List[Dict[str, str]]) -> str:
-    try:
-        import google.generativeai as genai
-        api_key = os.environ.get("GOOGLE_API_KEY")
-        if not api_key:
-            return "GOOGLE_API_KEY not configured"
-        genai.configure(api_key=api_key)
-        sys = "" 
-        parts = []
-        for m in messages:
-            if m.get("role") == "system":
-                sys = m.get("content", "")
-            elif m.get("role") in ("user", "assistant"):
-                parts.append(f"{m.get('role')}: {m.get('content','')}")
-        model_obj = genai.GenerativeModel(model)
-        prompt = (sys + "\n\n" + "\n".join(parts)).strip()
-        resp = model_obj.generate_content(prompt)
-        return getattr(resp, "text", "") or ""
-    except Exception as e:
-        return f"Gemini error: {e}"
+def estimate_tokens(text: str, family: str = "openai") -> int:
+    if not text:
+        return 0
+    if family == "openai":
+        try:
+            import tiktoken
+            return len(tiktoken.get_encoding("o200k_base").encode(text))
+        except Exception:
+            pass
+    return int(len(text) / _CHARS_PER_TOKEN.get(family, 4.0)) + 1
+
+def _msg_tokens(m: Dict[str, Any], family: str) -> int:
+    return estimate_tokens(str(m.get("content") or ""), family) + _MSG_OVERHEAD
+
+def _summarize_turns(turns: List[Dict[str, Any]], max_tokens: int, family: str) -> str:
+    # Extractive: the opening sentence of each dropped turn, newest turns first until the budget is spent
+    lines = []
+    used = 0
+    for m in reversed(turns):
+        text = " ".join(str(m.get("content") or "").split())
+        first = re.split(r"(?<=[.!?])\s", text, maxsplit=1)[0][:200]
+        if not first:
+            continue
+        line = f"- {m.get('role')}: {first}"
+        cost = estimate_tokens(line, family) + 1
+        if used + cost > max_tokens:
+            break
+        lines.append(line)
+        used += cost
+    return "\n".join(reversed(lines))
+
+def pack_context(family: str, chat_messages: List[Dict[str, Any]], documents: List[str], images: List[Dict[str, Any]], include_docs: bool = True):
+    """Fit system prompt, latest turn, images, document chunks and history into LLM_CONTEXT_TOKENS.
+
+    The system prompt and latest user turn are always kept. Images come next, then documents
+    (up to LLM_DOC_SHARE of what is left), then history newest first; older turns that do not
+    fit are replaced by a short extractive summary. Returns (messages, images, token report).
+    """
+    cpt = _CHARS_PER_TOKEN.get(family, 4.0)
+    budget = env_int("LLM_CONTEXT_TOKENS", 16000) - env_int("LLM_RESPONSE_TOKENS", 1000)
+    system = [str(m.get("content") or "") for m in chat_messages if m.get("role") == "system"]
+    turns = [m for m in chat_messages if m.get("role") in ("user", "assistant")]
+    latest = turns[-1:] if turns and turns[-1].get("role") == "user" else []
+    history = turns[:len(turns) - len(latest)]
+    report = {"system": sum(estimate_tokens(t, family) for t in system), "latest": sum(_msg_tokens(m, family) for m in latest)}
+    left = budget - report["system"] - report["latest"]
+
+    kept_images = []
+    per_image = _IMAGE_TOKENS.get(family, 765)
+    for im in images or []:
+        if im.get("data") and left >= per_image:
+            kept_images.append(im)
+            left -= per_image
+    wanted = sum(1 for im in images or [] if im.get("data"))
+    if len(kept_images) < wanted:
+        logging.warning("Context budget: dropped %d image(s)", wanted - len(kept_images))
+    report["images"] = per_image * len(kept_images)
+    report["image_bytes"] = sum(im.get("bytes_out", 0) for im in kept_images)
+    report["image_bytes_saved"] = sum(im.get("bytes_in", 0) - im.get("bytes_out", 0) for im in kept_images)
+
+    ctx = ""
+    if include_docs and documents and left > 0:
+        share = max(0.0, min(1.0, env_float("LLM_DOC_SHARE", 0.5)))
+        query = str(latest[0].get("content") or "") if latest else ""
+        ctx = _docs_to_context(documents, query, max_chars=int(left * share * cpt))
+    report["docs"] = estimate_tokens(ctx, family)
+    left -= report["docs"]
+
+    kept = []
+    for m in reversed(history):
+        cost = _msg_tokens(m, family)
+        if cost > left:
+            break
+        kept.append(m)
+        left -= cost
+    kept.reverse()
+    dropped = history[:len(history) - len(kept)]
+    summary = _summarize_turns(dropped, max(0, min(left, env_int("LLM_SUMMARY_TOKENS", 300))), family) if dropped else ""
+    report["history"] = sum(_msg_tokens(m, family) for m in kept) + estimate_tokens(summary, family)
+    report["turns_kept"] = len(kept)
+    report["turns_summarized"] = len(dropped)
 
-def _images_to_context(images: List[str]) -> List[Dict[str, Any]]:
+    sys_parts = []
+    if ctx:
+        sys_parts.append("Document context:\n" + ctx)
+    sys_parts.extend(t for t in system if t)
+    if summary:
+        sys_parts.append("Earlier conversation (summary):\n" + summary)
+    # One system message: the Anthropic and Gemini adapters keep only a single system prompt
+    messages = ([{"role": "system", "content": "\n\n".join(sys_parts)}] if sys_parts else []) + kept + latest
+    report["total"] = report["system"] + report["latest"] + report["images"] + report["docs"] + report["history"]
+    return messages, kept_images, report
+
+_clients: Dict[tuple, Any] = {}
+_clients_lock = threading.Lock()
+
+def _get_client(provider: str, api_key: str):
+    """Process-wide SDK client per provider and API key, so HTTP keep-alive connections are reused.
+
+    SDK retries are off: falling back across models and the circuit breaker own retrying, and
+    hidden retries would spend the adaptive timeout budget several times over.
+    """
+    key = (provider, api_key)
+    with _clients_lock:
+        c = _clients.get(key)
+        if c is None:
+            if provider == "openai":
+                c = OpenAI(api_key=api_key, max_retries=0)
+            elif provider == "anthropic":
+                import anthropic
+                c = anthropic.Anthropic(api_key=api_key, max_retries=0)
+            elif provider == "gemini":
+                import google.generativeai as genai
+                # genai keeps its configuration globally; only reconfigure when the key changes
+                genai.configure(api_key=api_key)
+                c = genai
+                for k in [k for k in _clients if k[0] == "gemini"]:
+                    del _clients[k]
+            else:
+                raise ValueError(f"unknown provider {provider}")
+            _clients[key] = c
+        return c
+
+def _get_async_client(provider: str, api_key: str):
+    """Async SDK client per provider and API key. Async clients bind to the loop that first uses
+    them, so these are only used on the shared event loop (tools.aio)."""
+    if provider == "gemini":
+        # genai has no separate async client: generate_content_async uses the module configuration
+        return _get_client(provider, api_key)
+    key = (provider, api_key, "async")
+    with _clients_lock:
+        c = _clients.get(key)
+        if c is None:
+            if provider == "openai":
+                c = AsyncOpenAI(api_key=api_key, max_retries=0)
+            elif provider == "anthropic":
+                import anthropic
+                c = anthropic.AsyncAnthropic(api_key=api_key, max_retries=0)
+            else:
+                raise ValueError(f"unknown provider {provider}")
+            _clients[key] = c
+        return c
+
+# genai's gapic layer retries ServiceUnavailable by default; retry=None turns that off like max_retries=0
+_GEMINI_NO_RETRY = {"retry": None}
+
+def _temp_kw(temperature: float | None) -> Dict[str, float]:
+    return {} if temperature is None else {"temperature": temperature}
+
+def _anthropic_payload(messages: List[Dict[str, str]]):
+    # Convert to Anthropic format: system + user turns
+    system_msg = "" 
+    content = []
+    for m in messages:
+        if m.get("role") == "system":
+            system_msg = m.get("content", "")
+        elif m.get("role") == "user":
+            content.append({"role": "user", "content": m.get("content", "")})
+        elif m.get("role") == "assistant":
+            content.append({"role": "assistant", "content": m.get("content", "")})
+    return system_msg, content
+
+def _openai_image_messages(messages: List[Dict[str, Any]], imgs: List[Dict[str, Any]]):
+    content = []
+    content.append({"type":"text","text":"".join([x.get('content','') for x in messages if x.get('role')=='user'])})
+    for im in imgs:
+        if im["data"]:
+            content.append({"type":"image_url","image_url":{"url":f"data:{im['mime']};base64,{im['data']}"}})
+    return [{"role":"user","content":content}]
+
+def _gemini_parts(messages: List[Dict[str, Any]], imgs: List[Dict[str, Any]]):
+    sys = "" 
+    parts = []
+    for mobj in messages:
+        if mobj.get("role") == "system": sys = mobj.get("content", "")
+        elif mobj.get("role") in ("user","assistant"):
+            parts.append(mobj.get("content",""))
+    # Gemini can take images via bytes
+    gem_parts = [sys + "\n\n" + "\n".join(parts)]
+    for im in imgs:
+        if im["data"]:
+            gem_parts.append({"mime_type": im["mime"] or "image/png", "data": base64.b64decode(im["data"])})
+    return gem_parts
+
+def _images_to_context(images: List[str], family: str = "openai") -> List[Dict[str, Any]]:
     items = []
     for p in images or []:
         try:
-            with open(p, "rb") as f:
-                b64 = base64.b64encode(f.read()).decode("ascii")
-            mime = "image/png"
-            if p.lower().endswith(".jpg") or p.lower().endswith(".jpeg"): mime = "image/jpeg"
-            elif p.lower().endswith(".webp"): mime = "image/webp"
-            items.append({"data": b64, "mime": mime, "name": os.path.basename(p)})
+            items.append(prepare_image(p, family))
         except Exception:
-            items.append({"data": None, "mime": None, "name": os.path.basename(p)})
+            items.append({"data": None, "mime": None, "name": os.path.basename(p), "bytes_in": 0, "bytes_out": 0})
     return items
 
 def call_openai_chat(model: str, messages: list) -> str:
@@ -106,6 +283,7 @@ def call_openai_chat(model: str, messages: list) -> str:
     Returns assistant text or raises Exception
     """
     try:
+        client = _get_client("openai", os.getenv("OPENAI_API_KEY") or "")
         resp = client.chat.completions.create(model=model, messages=messages)
         # safe-extract content
         choice = resp.choices[0]
@@ -121,84 +299,539 @@ def call_openai_chat(model: str, messages: list) -> str:
         logging.exception("OpenAI call failed")
         raise
 
-def route(models: List[str], documents: List[str], chat_messages: List[Dict[str, str]], images: List[str] | None = None, include_docs: bool = True) -> str:
-    ctx = _docs_to_context(documents) if include_docs else ""
-    imgs = _images_to_context(images or [])
-    messages = chat_messages.copy()
-    if ctx:
-        messages = [{"role": "system", "content": "Document context:\n" + ctx}] + messages
-    for m in models or []:
-        if m.startswith("openai:"):
-            model = m.split(":",1)[1]
-            if imgs:
+_PROVIDER_KEYS = {"openai": "OPENAI_API_KEY", "anthropic": "ANTHROPIC_API_KEY", "gemini": "GOOGLE_API_KEY"}
+
+def _resolve(m: str):
+    """(family, model name, api key) for a "provider:model" id, or LLMConfigError."""
+    family = _family(m)
+    env = _PROVIDER_KEYS.get(family)
+    if not env or ":" not in m:
+        raise LLMConfigError(f"unsupported model {m}", m)
+    api_key = os.environ.get(env)
+    if not api_key:
+        raise LLMConfigError(f"{env} not configured", m)
+    return family, m.split(":", 1)[1], api_key
+
+def _provider_error(m: str, e: Exception) -> LLMError:
+    if isinstance(e, LLMError):
+        return e
+    if "timeout" in type(e).__name__.lower():
+        return LLMTimeout(f"timed out: {e}", m)
+    return LLMProviderError(f"{type(e).__name__}: {e}", m)
+
+def _timeout_error(m: str, timeout: float | None) -> LLMTimeout:
+    return LLMTimeout(f"no response within {timeout:g}s", m)
+
+async def _acall_model(m: str, messages: List[Dict[str, Any]], imgs: List[Dict[str, Any]], temperature: float | None = None, timeout: float | None = None) -> str:
+    """Reply text from one model; raises LLMError. A timeout cancels the request."""
+    family, model, api_key = _resolve(m)
+    try:
+        client = _get_async_client(family, api_key)
+        if family == "openai":
+            msgs = _openai_image_messages(messages, imgs) if imgs else messages
+            resp = await asyncio.wait_for(client.chat.completions.create(model=model, messages=msgs, **_temp_kw(temperature)), timeout)
+            out = resp.choices[0].message.content or ""
+        elif family == "anthropic":
+            system_msg, content = _anthropic_payload(messages)
+            msg = await asyncio.wait_for(client.messages.create(model=model, max_tokens=1000, system=system_msg or None, messages=content,
+                                                                **_temp_kw(temperature)), timeout)
+            out = "".join([b.text for b in msg.content if hasattr(b, "text")])
+        else:
+            config = {"generation_config": {"temperature": temperature}} if temperature is not None else {}
+            resp = await asyncio.wait_for(client.GenerativeModel(model).generate_content_async(_gemini_parts(messages, imgs), **config,
+                                                                                                 request_options=_GEMINI_NO_RETRY), timeout)
+            out = getattr(resp, "text", "") or ""
+    except asyncio.TimeoutError as e:
+        raise _timeout_error(m, timeout) from e
+    except Exception as e:
+        raise _provider_error(m, e) from e
+    if not out.strip():
+        raise LLMProviderError("empty response", m)
+    return out
+
+class ProviderHealth:
+    """Latency window, adaptive timeout and circuit breaker for one provider family.
+
+    The breaker opens after LLM_BREAKER_FAILURES consecutive failures. After LLM_BREAKER_COOLDOWN
+    seconds a single trial call is let through (half-open); its outcome closes or re-opens it.
+    A trial that ends without an outcome (cancelled as a hedge loser, or by its caller) frees
+    the slot for the next call:
+
+    >>> import sys, asyncio
+    >>> router = sys.modules[__name__]
+    >>> h = router._health["anthropic"] = ProviderHealth("anthropic")
+    >>> h.state = "half-open"
+    >>> os.environ["ANTHROPIC_API_KEY"] = os.environ.get("ANTHROPIC_API_KEY") or "test"
+    >>> async def hang(*args, **kwargs):
+    ...     await asyncio.sleep(60)
+    >>> async def cancelled_trial():
+    ...     task = asyncio.ensure_future(router._aguarded_call("anthropic:claude", [], []))
+    ...     await asyncio.sleep(0)
+    ...     task.cancel()
+    ...     await asyncio.gather(task, return_exceptions=True)
+    >>> real, router._acall_model = router._acall_model, hang
+    >>> try:
+    ...     asyncio.run(cancelled_trial())
+    ... finally:
+    ...     router._acall_model = real
+    ...     del router._health["anthropic"]
+    >>> h.state, h._trial, h.allow()
+    ('half-open', False, True)
+    """
+
+    def __init__(self, family: str):
+        self.family = family
+        self._lock = threading.Lock()
+        self._lat = deque(maxlen=200)
+        self.failures = 0
+        self.state = "closed"
+        self._opened_at = 0.0
+        self._trial = False
+
+    def _move(self, state: str, reason: str = "") -> None:
+        logging.warning("LLM breaker %s: %s -> %s%s", self.family, self.state, state, f" ({reason})" if reason else "")
+        self.state = state
+
+    def timeout(self) -> float:
+        """LLM_TIMEOUT_FACTOR x observed p95, clamped to [LLM_TIMEOUT_MIN, LLM_TIMEOUT_MAX] seconds."""
+        lo, hi = env_float("LLM_TIMEOUT_MIN", 10), env_float("LLM_TIMEOUT_MAX", 60)
+        with self._lock:
+            lat = sorted(self._lat)
+        if len(lat) < 5:
+            return hi
+        p95 = lat[int(0.95 * (len(lat) - 1))] / 1000
+        return max(lo, min(hi, p95 * env_float("LLM_TIMEOUT_FACTOR", 3)))
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == "open" and time.monotonic() - self._opened_at >= env_float("LLM_BREAKER_COOLDOWN", 60):
+                self._move("half-open")
+                self._trial = False
+            if self.state == "closed":
+                return True
+            if self.state == "half-open" and not self._trial:
+                self._trial = True
+                return True
+            return False
+
+    def success(self, ms: float | None = None) -> None:
+        with self._lock:
+            if ms is not None:
+                self._lat.append(ms)
+            self.failures = 0
+            self._trial = False
+            if self.state != "closed":
+                self._move("closed")
+
+    def release(self) -> None:
+        """End a call that gave no verdict; a half-open trial slot is freed for the next call."""
+        with self._lock:
+            self._trial = False
+
+    def failure(self, err: Exception) -> None:
+        with self._lock:
+            self.failures += 1
+            self._trial = False
+            if self.state == "half-open" or (self.state == "closed" and self.failures >= env_int("LLM_BREAKER_FAILURES", 3)):
+                self._opened_at = time.monotonic()
+                self._move("open", str(err))
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            lat = sorted(self._lat)
+            state, failures = self.state, self.failures
+        return {"state": state, "failures": failures, "samples": len(lat),
+                "p50_ms": round(lat[len(lat) // 2], 1) if lat else None, "timeout_s": round(self.timeout(), 1)}
+
+_health: Dict[str, ProviderHealth] = {}
+_health_lock = threading.Lock()
+
+def _health_for(family: str) -> ProviderHealth:
+    with _health_lock:
+        h = _health.get(family)
+        if h is None:
+            h = _health[family] = ProviderHealth(family)
+        return h
+
+def model_stats() -> Dict[str, Dict[str, Any]]:
+    """Rolling per-model latency percentiles, success rate, tokens and estimated cost per request."""
+    return get_stats().summaries()
+
+def provider_health() -> Dict[str, Dict[str, Any]]:
+    with _health_lock:
+        items = list(_health.items())
+    return {family: h.snapshot() for family, h in items}
+
+async def _aguarded_call(m: str, messages: List[Dict[str, Any]], imgs: List[Dict[str, Any]], temperature: float | None = None, tokens: int = 0) -> str:
+    """_acall_model behind the provider's circuit breaker, with its adaptive timeout.
+
+    tokens is the estimated prompt size; the outcome is added to the persisted per-model stats.
+    """
+    family = _resolve(m)[0]
+    h = _health_for(family)
+    if not h.allow():
+        raise LLMCircuitOpen(f"{family} circuit open; skipped", m)
+    t0 = time.perf_counter()
+    try:
+        out = await _acall_model(m, messages, imgs, temperature, timeout=h.timeout())
+    except LLMError as e:
+        h.failure(e)
+        get_stats().record(m, (time.perf_counter() - t0) * 1000, False, tokens)
+        raise
+    except BaseException:
+        # Cancelled, e.g. a hedge loser: no verdict on the provider
+        h.release()
+        raise
+    ms = (time.perf_counter() - t0) * 1000
+    h.success(ms)
+    get_stats().record(m, ms, True, tokens + estimate_tokens(out, family))
+    return out
+
+_response_cache = None
+_saved_ms = 0.0
+
+def _get_response_cache():
+    global _response_cache
+    if _response_cache is None:
+        from .cache import ContentCache, cache_root
+        disk = os.path.join(cache_root(), "llm") if env_flag("LLM_CACHE_DISK", True) else None
+        _response_cache = ContentCache(
+            "llm",
+            max_items=env_int("LLM_CACHE_ITEMS", 256),
+            disk_dir=disk,
+            max_disk_bytes=env_int("LLM_CACHE_MAX_MB", 64) * 1024 * 1024,
+            ttl=env_int("LLM_CACHE_TTL", 86400) or None,
+        )
+    return _response_cache
+
+def _cacheable(temperature: float | None, cache: bool | None) -> bool:
+    # Only deterministic requests are replayed: temperature 0, or callers that opt in explicitly
+    if not env_flag("LLM_CACHE", False) or cache is False:
+        return False
+    return cache is True or temperature == 0
+
+def _cache_key(m: str, messages: List[Dict[str, Any]], imgs: List[Dict[str, Any]], temperature: float | None) -> str:
+    from .cache import sha256_bytes
+    norm = [[x.get("role"), " ".join(str(x.get("content") or "").split())] for x in messages]
+    img_hashes = [sha256_bytes(im["data"].encode("ascii")) for im in imgs if im.get("data")]
+    payload = json.dumps({"model": m, "messages": norm, "images": img_hashes, "temperature": temperature}, sort_keys=True)
+    return sha256_bytes(payload.encode("utf-8"))
+
+def llm_cache_stats() -> Dict[str, Any]:
+    out = _get_response_cache().stats()
+    out["saved_ms"] = round(_saved_ms, 1)
+    return out
+
+def _prepare(models, documents, chat_messages, images, include_docs, temperature, cache):
+    """Pack context per provider family; returns (cached reply or None, attempts)."""
+    global _saved_ms
+    use_cache = _cacheable(temperature, cache)
+    packed = {}
+    attempts = []
+    for m in order_models(models or []):
+        family = _family(m)
+        if family not in packed:
+            # Images are encoded per family: each provider has its own useful resolution
+            family_imgs = _images_to_context(images or [], family)
+            packed[family] = pack_context(family, chat_messages, documents, family_imgs, include_docs)
+        messages, imgs, report = packed[family]
+        key = _cache_key(m, messages, imgs, temperature) if use_cache else None
+        if key:
+            hit = _get_response_cache().get(key)
+            if hit is not None:
+                _saved_ms += hit.get("ms", 0.0)
+                logging.info("LLM cache hit %s (saved ~%.0f ms)", m, hit.get("ms", 0.0))
+                return hit["text"], []
+        attempts.append((m, messages, imgs, report, key))
+    return None, attempts
+
+def _log_request(m, report):
+    logging.info(
+        "LLM request %s: ~%d tokens (system %d, latest %d, docs %d, history %d [%d kept, %d summarized], images %d)"
+        "; image bytes %d (saved %d)",
+        m, report["total"], report["system"], report["latest"], report["docs"], report["history"],
+        report["turns_kept"], report["turns_summarized"], report["images"],
+        report["image_bytes"], report["image_bytes_saved"],
+    )
+
+_hedge_lock = threading.Lock()
+_hedge_stats: Dict[str, Dict[str, Any]] = {}
+
+def _hedge_delay() -> float | None:
+    # Unset or negative: sequential fallback. 0: race all models at once. >0: seconds before the next model starts.
+    delay = env_float("LLM_HEDGE_DELAY", -1.0)
+    return delay if delay >= 0 else None
+
+def _record_hedge(m: str, launched: bool = False, won: bool = False, ms: float | None = None) -> None:
+    with _hedge_lock:
+        st = _hedge_stats.setdefault(m, {"launched": 0, "wins": 0, "ok": 0, "lat": []})
+        st["launched"] += int(launched)
+        st["wins"] += int(won)
+        if ms is not None:
+            st["ok"] += 1
+            st["lat"].append(ms)
+            del st["lat"][:-256]
+
+def hedge_stats() -> Dict[str, Dict[str, Any]]:
+    """Per-model launches, wins, win rate and good-answer latency from hedged routing."""
+    out = {}
+    with _hedge_lock:
+        for m, st in _hedge_stats.items():
+            lat = sorted(st["lat"])
+            pct = lambda q: round(lat[min(len(lat) - 1, int(q * len(lat)))], 1) if lat else None
+            out[m] = {"launched": st["launched"], "wins": st["wins"], "ok": st["ok"],
+                      "win_rate": st["wins"] / st["launched"] if st["launched"] else 0.0,
+                      "p50_ms": pct(0.5), "p95_ms": pct(0.95)}
+    return out
+
+async def _store_reply(key: str | None, text: str, ms: float) -> None:
+    if key:
+        await asyncio.to_thread(_get_response_cache().put, key, {"text": text, "ms": ms})
+
+async def _arace(attempts, temperature, delay):
+    """Start attempts staggered by delay seconds; first good answer wins, the rest are cancelled."""
+    loop = asyncio.get_running_loop()
+    pending = list(attempts)
+    running = {}
+    errors = []
+    t_next = loop.time()
+
+    async def call(m, messages, imgs, tokens):
+        t0 = time.perf_counter()
+        out = await _aguarded_call(m, messages, imgs, temperature, tokens)
+        ms = (time.perf_counter() - t0) * 1000
+        _record_hedge(m, ms=ms)
+        return out, ms
+
+    try:
+        while pending or running:
+            if pending and (not running or loop.time() >= t_next):
+                m, messages, imgs, report, key = pending.pop(0)
+                _log_request(m, report)
+                _record_hedge(m, launched=True)
+                running[asyncio.ensure_future(call(m, messages, imgs, report["total"]))] = (m, key)
+                t_next = loop.time() + delay
+                continue
+            wait = max(0.0, t_next - loop.time()) if pending else None
+            done, _ = await asyncio.wait(list(running), timeout=wait, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                m, key = running.pop(task)
                 try:
-                    client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-                    content = []
-                    content.append({"type":"text","text":"".join([x.get('content','') for x in messages if x.get('role')=='user'])})
-                    for im in imgs:
-                        if im["data"]:
-                            content.append({"type":"image_url","image_url":{"url":f"data:{im['mime']};base64,{im['data']}"}})
-                    resp = client.chat.completions.create(model=model, messages=[{"role":"user","content":content}])
-                    out = resp.choices[0].message.content or ""
+                    out, ms = task.result()
                 except Exception as e:
-                    out = f"OpenAI error: {e}"
-            else:
-                out = _call_openai(model, messages)
-            if out and "API_KEY" not in out and "error" not in out.lower():
-                return out
-        elif m.startswith("anthropic:"):
-            model = m.split(":",1)[1]
-            out = _call_anthropic(model, messages)
-            if out and "API_KEY" not in out and "error" not in out.lower():
+                    errors.append(_provider_error(m, e))
+                    # A failed model frees its slot: start the next one now rather than after the delay
+                    t_next = loop.time()
+                    continue
+                _record_hedge(m, won=True)
+                logging.info("LLM hedge: %s won after %.0f ms (%d cancelled)", m, ms, len(running) + len(pending))
+                await _store_reply(key, out, ms)
                 return out
-        elif m.startswith("vertex:") or m.startswith("google:") or m.startswith("gemini:"):
-            model = m.split(":",1)[1]
+    finally:
+        for task in running:
+            task.cancel()
+    raise LLMUnavailable(errors)
+
+async def _aroute(models, documents, chat_messages, images, include_docs, temperature, cache) -> str:
+    # Packing reads documents and images from disk, so it runs off the event loop
+    hit, attempts = await asyncio.to_thread(_prepare, models, documents, chat_messages, images, include_docs, temperature, cache)
+    if hit is not None:
+        return hit
+    delay = _hedge_delay()
+    if delay is not None and len(attempts) > 1:
+        return await _arace(attempts, temperature, delay)
+    errors = []
+    for m, messages, imgs, report, key in attempts:
+        _log_request(m, report)
+        t0 = time.perf_counter()
+        try:
+            out = await _aguarded_call(m, messages, imgs, temperature, report["total"])
+        except LLMError as e:
+            logging.warning("LLM %s failed: %s", m, e)
+            errors.append(e)
+            continue
+        await _store_reply(key, out, (time.perf_counter() - t0) * 1000)
+        return out
+    raise LLMUnavailable(errors)
+
+async def aroute(models: List[str], documents: List[str], chat_messages: List[Dict[str, str]], images: List[str] | None = None, include_docs: bool = True,
+                 temperature: float | None = None, cache: bool | None = None) -> str:
+    """route() for async callers; awaitable from any event loop, provider calls run on the shared loop."""
+    return await aio.on_loop(_aroute(models, documents, chat_messages, images, include_docs, temperature, cache))
+
+def route(models: List[str], documents: List[str], chat_messages: List[Dict[str, str]], images: List[str] | None = None, include_docs: bool = True,
+          temperature: float | None = None, cache: bool | None = None) -> str:
+    """First usable reply from models, tried in order (or raced, see LLM_HEDGE_DELAY).
+
+    temperature is passed to the provider when set. Replies are served from and stored in
+    the response cache (LLM_CACHE) only for deterministic requests; cache=False bypasses it.
+    Providers with an open circuit breaker are skipped. Raises LLMUnavailable when no model answers.
+    Blocks the calling thread; async code should await aroute() instead.
+    """
+    return aio.run(_aroute(models, documents, chat_messages, images, include_docs, temperature, cache))
+
+async def _astream_model(m: str, messages: List[Dict[str, Any]], imgs: List[Dict[str, Any]], temperature: float | None = None):
+    """Yield text deltas from one provider; raises on missing keys and provider errors."""
+    family, model, api_key = _resolve(m)
+    client = _get_async_client(family, api_key)
+    if family == "openai":
+        msgs = _openai_image_messages(messages, imgs) if imgs else messages
+        stream = await client.chat.completions.create(model=model, messages=msgs, stream=True, **_temp_kw(temperature))
+        async for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+    elif family == "anthropic":
+        system_msg, content = _anthropic_payload(messages)
+        async with client.messages.stream(model=model, max_tokens=1000, system=system_msg or None, messages=content, **_temp_kw(temperature)) as stream:
+            async for text in stream.text_stream:
+                yield text
+    else:
+        config = {"generation_config": {"temperature": temperature}} if temperature is not None else {}
+        resp = await client.GenerativeModel(model).generate_content_async(_gemini_parts(messages, imgs), stream=True, **config,
+                                                                  request_options=_GEMINI_NO_RETRY)
+        async for chunk in resp:
+            text = getattr(chunk, "text", "")
+            if text:
+                yield text
+
+_ttft: Dict[str, List[float]] = {}
+_ttft_lock = threading.Lock()
+
+def _record_ttft(family: str, ms: float) -> None:
+    with _ttft_lock:
+        lat = _ttft.setdefault(family, [])
+        lat.append(ms)
+        del lat[:-256]
+
+def ttft_stats() -> Dict[str, Dict[str, Any]]:
+    """Time-to-first-token per provider family over recent streamed requests."""
+    out = {}
+    with _ttft_lock:
+        for family, lat in _ttft.items():
+            s = sorted(lat)
+            out[family] = {"count": len(s), "p50_ms": round(s[len(s) // 2], 1), "last_ms": round(lat[-1], 1)}
+    return out
+
+async def _aroute_stream(models, documents, chat_messages, images, include_docs, temperature, cache):
+    hit, attempts = await asyncio.to_thread(_prepare, models, documents, chat_messages, images, include_docs, temperature, cache)
+    if hit is not None:
+        yield hit
+        return
+    errors = []
+    for m, messages, imgs, report, key in attempts:
+        try:
+            h = _health_for(_resolve(m)[0])
+        except LLMError as e:
+            errors.append(e)
+            continue
+        if not h.allow():
+            errors.append(LLMCircuitOpen(f"{h.family} circuit open; skipped", m))
+            continue
+        _log_request(m, report)
+        timeout = h.timeout()
+        t0 = time.perf_counter()
+        parts = []
+        deltas = _astream_model(m, messages, imgs, temperature)
+        try:
+            while True:
+                # The adaptive timeout bounds the wait for each chunk, the first one included
+                try:
+                    delta = await asyncio.wait_for(deltas.__anext__(), timeout)
+                except StopAsyncIteration:
+                    break
+                if not parts:
+                    ms = (time.perf_counter() - t0) * 1000
+                    _record_ttft(_family(m), ms)
+                    logging.info("LLM stream %s: first token after %.0f ms", m, ms)
+                parts.append(delta)
+                yield delta
+        except Exception as e:
+            err = _timeout_error(m, timeout) if isinstance(e, asyncio.TimeoutError) else _provider_error(m, e)
+            h.failure(err)
+            get_stats().record(m, (time.perf_counter() - t0) * 1000, False, report["total"])
+            if not parts:
+                logging.warning("LLM stream %s failed: %s", m, err)
+                errors.append(err)
+                continue
+            logging.warning("LLM stream %s interrupted: %s", m, err)
+            yield f"\n\n[response interrupted: {err}]"
+            return
+        finally:
             try:
-                import google.generativeai as genai
-                api_key = os.environ.get("GOOGLE_API_KEY")
-                if not api_key:
-                    out = "GOOGLE_API_KEY not configured"
-                else:
-                    genai.configure(api_key=api_key)
-                    sys = "" 
-                    parts = []
-                    for mobj in messages:
-                        if mobj.get("role") == "system": sys = mobj.get("content", "")
-                        elif mobj.get("role") in ("user","assistant"):
-                            parts.append(mobj.get("content",""))
-                    model_obj = genai.GenerativeModel(model)
-                    # Gemini can take images via bytes
-                    gem_parts = [sys + "\n\n" + "\n".join(parts)]
-                    for im in imgs:
-                        if im["data"]:
-                            import base64
-                            gem_parts.append({"mime_type": im["mime"] or "image/png", "data": base64.b64decode(im["data"])})
-                    resp = model_obj.generate_content(gem_parts)
-                    out = getattr(resp, "text", "") or ""
-            except Exception as e:
-                out = f"Gemini error: {e}"
-            if out and "API_KEY" not in out and "error" not in out.lower():
-                return out
-    return "Cannot call model. Check model choices and environment API keys."
+                await deltas.aclose()
+            finally:
+                # Closed early by the consumer or cancelled: success() and failure() never ran
+                h.release()
+        if not parts:
+            h.failure(LLMProviderError("empty response", m))
+            errors.append(LLMProviderError("empty response", m))
+            continue
+        # Streamed latency is not comparable to whole-reply latency, so it does not feed the timeout window
+        h.success()
+        get_stats().record(m, (time.perf_counter() - t0) * 1000, True, report["total"] + estimate_tokens("".join(parts), h.family))
+        await _store_reply(key, "".join(parts), (time.perf_counter() - t0) * 1000)
+        return
+    raise LLMUnavailable(errors)
+
+def aroute_stream(models: List[str], documents: List[str], chat_messages: List[Dict[str, str]], images: List[str] | None = None, include_docs: bool = True,
+                  temperature: float | None = None, cache: bool | None = None):
+    """route_stream() as an async generator, usable from any event loop."""
+    return aio.aiterate(_aroute_stream(models, documents, chat_messages, images, include_docs, temperature, cache))
+
+def route_stream(models: List[str], documents: List[str], chat_messages: List[Dict[str, str]], images: List[str] | None = None, include_docs: bool = True,
+                 temperature: float | None = None, cache: bool | None = None):
+    """Streaming route(): yields reply text as it arrives.
+
+    Models are tried in order until one produces a first token; once text has been
+    yielded there is no fallback, so a mid-stream failure ends the reply with a note.
+    Raises LLMUnavailable, before yielding anything, when no model answers.
+    """
+    return aio.iterate(_aroute_stream(models, documents, chat_messages, images, include_docs, temperature, cache))
+
+_preflight_cache: Dict[tuple, tuple] = {}
+_preflight_refreshing = set()
+_preflight_lock = threading.Lock()
+_http = requests.Session()
+
+def _check_provider(provider: str, api_key: str) -> bool:
+    if provider == "openai":
+        r = _http.get("https://api.openai.com/v1/models", headers={"Authorization": f"Bearer {api_key}"}, timeout=5)
+        return r.status_code == 200
+    return True
+
+def _refresh_preflight(key: tuple) -> None:
+    try:
+        ok = _check_provider(*key)
+    except Exception:
+        ok = False
+    with _preflight_lock:
+        _preflight_cache[key] = (ok, time.monotonic())
+        _preflight_refreshing.discard(key)
 
 def preflight(models: List[str]) -> Dict[str, bool]:
+    """Provider reachability from a TTL cache (PREFLIGHT_TTL); stale or unknown entries refresh in the background.
+
+    A provider with a key but no cached result is reported as available until its first check lands.
+    """
+    ttl = env_int("PREFLIGHT_TTL", 300)
     status = {}
     for m in models or []:
-        try:
-            if m.startswith("openai:"):
-                api_key = os.environ.get("OPENAI_API_KEY")
-                if not api_key:
-                    status["openai"] = False
-                else:
-                    r = requests.get("https://api.openai.com/v1/models", headers={"Authorization": f"Bearer {api_key}"}, timeout=5)
-                    status["openai"] = (r.status_code == 200)
-            elif m.startswith("anthropic:"):
-                api_key = os.environ.get("ANTHROPIC_API_KEY")
-                status["anthropic"] = bool(api_key)
-            elif m.startswith("gemini:") or m.startswith("google:") or m.startswith("vertex:"):
-                api_key = os.environ.get("GOOGLE_API_KEY")
-                status["gemini"] = bool(api_key)
-        except Exception:
-            if m.startswith("openai:"):
-                status["openai"] = False
+        family = _family(m)
+        env = _PROVIDER_KEYS.get(family)
+        if not env:
+            continue
+        api_key = os.environ.get(env)
+        if not api_key:
+            status[family] = False
+            continue
+        key = (family, api_key)
+        with _preflight_lock:
+            hit = _preflight_cache.get(key)
+            fresh = hit is not None and time.monotonic() - hit[1] < ttl
+            start = not fresh and key not in _preflight_refreshing
+            if start:
+                _preflight_refreshing.add(key)
+        if start:
+            threading.Thread(target=_refresh_preflight, args=(key,), name="preflight", daemon=True).start()
+        status[family] = hit[0] if hit is not None else True
     return status
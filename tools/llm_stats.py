@@ -0,0 +1,170 @@
+import os
+import json
+import time
+import atexit
+import logging
+import threading
+from collections import deque
+from typing import Any, Dict, List
+from .cache import cache_root, write_atomic
+from .env import env_float, env_int
+
+# Quality tier (higher is stronger) and blended USD per 1M tokens; override or extend with LLM_MODEL_PROFILES (JSON)
+MODEL_PROFILES = {
+    "openai:gpt-4o-mini": {"tier": 2, "cost": 0.3},
+    "openai:gpt-4o": {"tier": 3, "cost": 5.0},
+    "openai:gpt-4.1-mini": {"tier": 2, "cost": 0.8},
+    "openai:gpt-4.1": {"tier": 3, "cost": 4.0},
+    "anthropic:claude-3.5-haiku": {"tier": 2, "cost": 1.6},
+    "anthropic:claude-3.5-sonnet": {"tier": 3, "cost": 6.0},
+    "gemini:gemini-1.5-flash": {"tier": 1, "cost": 0.15},
+    "gemini:gemini-1.5-pro": {"tier": 3, "cost": 2.5},
+}
+
+def model_profiles() -> Dict[str, Dict[str, float]]:
+    profiles = {k: dict(v) for k, v in MODEL_PROFILES.items()}
+    raw = os.environ.get("LLM_MODEL_PROFILES")
+    if raw:
+        try:
+            for k, v in json.loads(raw).items():
+                profiles.setdefault(k, {}).update(v)
+        except Exception:
+            logging.warning("Ignoring malformed LLM_MODEL_PROFILES")
+    return profiles
+
+class ModelStats:
+    """Rolling per-model outcomes (latency, success, tokens), persisted as JSON so restarts keep history."""
+
+    def __init__(self, path: str | None, window: int = 100, save_interval: float = 10.0):
+        self.path = path
+        self.window = window
+        self.save_interval = save_interval
+        self._lock = threading.Lock()
+        self._rows: Dict[str, deque] = {}
+        self._dirty = False
+        self._saved_at = 0.0
+        self._saver: threading.Thread | None = None
+        self._load()
+
+    def _load(self) -> None:
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            for m, rows in (data.get("models") or {}).items():
+                self._rows[m] = deque((tuple(r) for r in rows), maxlen=self.window)
+        except Exception:
+            logging.warning("Could not load LLM stats from %s", self.path)
+
+    def save(self, force: bool = False) -> None:
+        with self._lock:
+            if not self.path or not self._dirty or (not force and time.monotonic() - self._saved_at < self.save_interval):
+                return
+            data = {"version": 1, "models": {m: list(rows) for m, rows in self._rows.items()}}
+            self._dirty = False
+            self._saved_at = time.monotonic()
+        try:
+            write_atomic(self.path, json.dumps(data).encode("utf-8"))
+        except Exception:
+            logging.exception("Could not save LLM stats")
+
+    def record(self, model: str, ms: float, ok: bool, tokens: int = 0) -> None:
+        with self._lock:
+            rows = self._rows.setdefault(model, deque(maxlen=self.window))
+            rows.append((round(time.time(), 1), round(ms, 1), bool(ok), int(tokens)))
+            self._dirty = True
+            due = bool(self.path) and time.monotonic() - self._saved_at >= self.save_interval and not (self._saver and self._saver.is_alive())
+            if due:
+                # Callers are coroutines on the shared event loop: write the file on a thread
+                self._saver = threading.Thread(target=self.save, name="llm-stats-save", daemon=True)
+                self._saver.start()
+
+    def flush(self) -> None:
+        """Wait for a background save, then write whatever is still unsaved."""
+        saver = self._saver
+        if saver is not None:
+            saver.join(5)
+        self.save(force=True)
+
+    def summary(self, model: str) -> Dict[str, Any] | None:
+        with self._lock:
+            rows = list(self._rows.get(model) or [])
+        if not rows:
+            return None
+        ok = [r for r in rows if r[2]]
+        lat = sorted(r[1] for r in ok)
+        pct = lambda q: round(lat[min(len(lat) - 1, int(q * len(lat)))], 1) if lat else None
+        tokens = sum(r[3] for r in ok) / len(ok) if ok else 0.0
+        cost = (model_profiles().get(model) or {}).get("cost")
+        return {
+            "requests": len(rows),
+            "success_rate": len(ok) / len(rows),
+            "p50_ms": pct(0.5),
+            "p95_ms": pct(0.95),
+            "avg_tokens": round(tokens, 1),
+            "est_cost_per_request": round(tokens * cost / 1e6, 6) if cost is not None else None,
+        }
+
+    def summaries(self) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            models = list(self._rows)
+        return {m: self.summary(m) for m in models}
+
+_stats: ModelStats | None = None
+_stats_lock = threading.Lock()
+
+def _save_on_exit() -> None:
+    if _stats is not None:
+        _stats.flush()
+
+atexit.register(_save_on_exit)
+
+def get_stats() -> ModelStats:
+    global _stats
+    with _stats_lock:
+        if _stats is None:
+            path = os.environ.get("LLM_STATS_FILE")
+            if path is None:
+                path = os.path.join(cache_root(), "llm_stats.json")
+            _stats = ModelStats(path or None, window=env_int("LLM_STATS_WINDOW", 100))
+        return _stats
+
+def order_models(models: List[str], policy: str | None = None) -> List[str]:
+    """Reorder candidate models by LLM_ROUTING_POLICY: given (default), fastest, cheapest or reliable.
+
+    Models below LLM_MIN_TIER or under LLM_MIN_SUCCESS go last rather than being dropped, so
+    they remain fallbacks. Models without enough history keep their given relative order after
+    the ones with measurements under the latency and reliability policies.
+    """
+    policy = (policy or os.environ.get("LLM_ROUTING_POLICY") or "given").strip().lower()
+    if policy == "given" or len(models or []) < 2:
+        return list(models or [])
+    profiles = model_profiles()
+    stats = get_stats()
+    min_tier = env_float("LLM_MIN_TIER", 0)
+    min_success = env_float("LLM_MIN_SUCCESS", 0.5)
+    min_samples = env_int("LLM_STATS_MIN_SAMPLES", 5)
+    inf = float("inf")
+
+    def key(item):
+        i, m = item
+        prof = profiles.get(m) or {}
+        st = stats.summary(m)
+        known = st is not None and st["requests"] >= min_samples
+        below_tier = prof.get("tier", min_tier) < min_tier
+        unreliable = known and st["success_rate"] < min_success
+        if policy == "cheapest":
+            metric = prof.get("cost", inf)
+        elif policy == "fastest":
+            metric = st["p50_ms"] if known and st["p50_ms"] is not None else inf
+        elif policy == "reliable":
+            metric = -st["success_rate"] if known else inf
+        else:
+            metric = 0
+        return (below_tier, unreliable, metric, i)
+
+    ordered = [m for _, m in sorted(enumerate(models), key=key)]
+    if ordered != list(models):
+        logging.info("LLM routing (%s): %s", policy, ", ".join(ordered))
+    return ordered
@@ -1,57 +1,302 @@
 import asyncio
+import atexit
+import concurrent.futures
+import logging
 import os
+import re
+import threading
+import time
 from typing import Any, Dict
+from . import aio
+from .env import env_flag, env_float, env_int
 
 def _no_mcp(msg: str) -> Dict[str, Any]:
     return {"error": msg}
 
-def call_tool(server_cmd: str, tool: str, params: Dict[str, Any] | None = None, timeout: int = 30) -> Dict[str, Any] | str:
-    try:
-        import anyio  # type: ignore
-    except Exception:
-        anyio = None
+def _pool_enabled() -> bool:
+    return env_flag("MCP_POOL", True)
+
+def _cmd_parts(server_cmd) -> list:
+    return list(server_cmd) if isinstance(server_cmd, (list, tuple)) else server_cmd.split()
+
+def _normalize_result(res: Any) -> Dict[str, Any] | str:
+    # Normalize a simple text/image response shape
+    if hasattr(res, "content") and isinstance(res.content, list):
+        text_chunks = []
+        out: Dict[str, Any] = {}
+        for c in res.content:
+            t = getattr(c, "text", None)
+            if t:
+                text_chunks.append(t)
+            data = getattr(c, "data", None)
+            mime = getattr(c, "mimeType", None) or getattr(c, "mime_type", None)
+            if data and mime and str(mime).startswith("image/") and "image_b64" not in out:
+                out["image_b64"] = data
+        if getattr(res, "isError", None) or getattr(res, "is_error", False):
+            return _no_mcp("\n".join(text_chunks) or "tool reported an error")
+        out["text"] = "\n".join(text_chunks)
+        return out
+    return res  # best-effort passthrough
+
+class _PooledSession:
+    """A long-lived, initialized ClientSession for one server command.
+
+    The stdio transport and session context managers must be entered and exited by the same
+    task, so a dedicated task owns them and parks until close() is requested.
+    """
+
+    def __init__(self, cmd_parts: list, max_inflight: int):
+        self.cmd_parts = cmd_parts
+        self.session = None
+        self.inflight = 0
+        self.last_used = time.monotonic()
+        self.last_ok = 0.0
+        self._slots = asyncio.Semaphore(max(1, int(max_inflight)))
+        self._ready = asyncio.Event()
+        self._stop = asyncio.Event()
+        self._task = None
+        self._error = None
+
+    @property
+    def alive(self) -> bool:
+        return self.session is not None and self._task is not None and not self._task.done()
+
+    async def start(self, timeout: float) -> None:
+        self._task = asyncio.get_running_loop().create_task(self._serve())
+        try:
+            await asyncio.wait_for(self._ready.wait(), timeout)
+        except asyncio.TimeoutError:
+            await self.close()
+            raise RuntimeError(f"MCP server did not initialize within {timeout}s")
+        if not self.alive:
+            raise RuntimeError(f"MCP server failed to start: {self._error}")
+
+    async def _serve(self) -> None:
+        from mcp import ClientSession, StdioServerParameters  # type: ignore
+        from mcp.client.stdio import stdio_client  # type: ignore
+        params = StdioServerParameters(command=self.cmd_parts[0], args=self.cmd_parts[1:], env=dict(os.environ))
+        try:
+            async with stdio_client(params) as (read, write):
+                async with ClientSession(read, write) as session:
+                    await session.initialize()
+                    self.session = session
+                    self.last_ok = time.monotonic()
+                    logging.info("MCP session started: %s", " ".join(self.cmd_parts))
+                    self._ready.set()
+                    await self._stop.wait()
+        except Exception as e:
+            self._error = e
+            logging.warning("MCP session for %s ended: %s", " ".join(self.cmd_parts), e)
+        finally:
+            self.session = None
+            self._ready.set()
+
+    async def call(self, tool: str, params: Dict[str, Any] | None, timeout: float) -> Any:
+        async with self._slots:
+            if not self.alive:
+                raise RuntimeError("MCP session closed")
+            self.inflight += 1
+            self.last_used = time.monotonic()
+            try:
+                res = await asyncio.wait_for(self.session.call_tool(tool, params or {}), timeout)
+                self.last_ok = time.monotonic()
+                return res
+            finally:
+                self.inflight -= 1
+                self.last_used = time.monotonic()
+
+    async def ping(self, timeout: float) -> bool:
+        try:
+            await asyncio.wait_for(self.session.send_ping(), timeout)
+            self.last_ok = time.monotonic()
+            return True
+        except Exception:
+            return False
+
+    async def close(self) -> None:
+        self._stop.set()
+        if self._task is not None and not self._task.done():
+            try:
+                await asyncio.wait_for(self._task, 5)
+            except Exception:
+                self._task.cancel()
+
+class SessionPool:
+    """Initialized MCP sessions keyed by server command, kept on the shared event loop (tools.aio).
+
+    Sessions are health-checked with a ping after sitting idle, restarted when the server
+    process dies, evicted after MCP_POOL_IDLE_TTL seconds unused, and limited to
+    MCP_POOL_MAX_INFLIGHT concurrent calls each. call() serves sync callers; call_async()
+    serves coroutines running on any event loop.
+    """
+
+    def __init__(self, max_inflight: int | None = None, idle_ttl: float | None = None,
+                 ping_interval: float | None = None, start_timeout: float | None = None):
+        self.max_inflight = max_inflight or env_int("MCP_POOL_MAX_INFLIGHT", 4)
+        self.idle_ttl = idle_ttl if idle_ttl is not None else env_float("MCP_POOL_IDLE_TTL", 300)
+        self.ping_interval = ping_interval if ping_interval is not None else env_float("MCP_POOL_PING_INTERVAL", 60)
+        # First start may download the server package (uvx), so allow more than a tool call
+        self.start_timeout = start_timeout if start_timeout is not None else env_float("MCP_POOL_START_TIMEOUT", 60)
+        self._lock = threading.Lock()
+        self._loop = None
+        self._reaper_fut = None
+        self._sessions: Dict[tuple, _PooledSession] = {}
+        self._key_locks: Dict[tuple, asyncio.Lock] = {}
+
+    def _ensure_loop(self) -> asyncio.AbstractEventLoop:
+        loop = aio.get_loop()
+        with self._lock:
+            if self._loop is not loop:
+                self._loop = loop
+                self._sessions = {}
+                self._key_locks = {}
+                self._reaper_fut = asyncio.run_coroutine_threadsafe(self._reaper(), loop)
+            return loop
+
+    async def _acquire(self, cmd_parts: list) -> _PooledSession:
+        key = tuple(cmd_parts)
+        lock = self._key_locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            s = self._sessions.get(key)
+            if s is not None and s.alive and s.inflight == 0 and time.monotonic() - s.last_ok > self.ping_interval:
+                if not await s.ping(5):
+                    logging.warning("MCP session for %s failed health check; restarting", " ".join(cmd_parts))
+                    await s.close()
+            if s is None or not s.alive:
+                s = _PooledSession(cmd_parts, self.max_inflight)
+                self._sessions[key] = s
+                try:
+                    await s.start(self.start_timeout)
+                except Exception:
+                    self._sessions.pop(key, None)
+                    raise
+            return s
+
+    async def _call(self, cmd_parts: list, tool: str, params: Dict[str, Any] | None, timeout: float) -> Any:
+        for attempt in range(2):
+            s = await self._acquire(cmd_parts)
+            try:
+                return await s.call(tool, params, timeout)
+            except asyncio.TimeoutError:
+                raise TimeoutError(f"MCP tool {tool} timed out after {timeout}s")
+            except Exception:
+                # A crashed server surfaces as a transport error; restart once and retry
+                if attempt == 0 and (not s.alive or not await s.ping(2)):
+                    logging.warning("MCP session for %s is down; restarting", " ".join(cmd_parts))
+                    await s.close()
+                    continue
+                raise
+
+    async def _reaper(self) -> None:
+        while True:
+            await asyncio.sleep(max(1.0, min(30.0, self.idle_ttl / 2)))
+            now = time.monotonic()
+            for key, s in list(self._sessions.items()):
+                if s.inflight == 0 and (now - s.last_used > self.idle_ttl or not s.alive):
+                    self._sessions.pop(key, None)
+                    logging.info("MCP session evicted: %s", " ".join(key))
+                    await s.close()
+
+    def call(self, server_cmd, tool: str, params: Dict[str, Any] | None = None, timeout: float = 30) -> Any:
+        loop = self._ensure_loop()
+        if aio.in_loop_thread():
+            raise RuntimeError("SessionPool.call() cannot block the pool loop; use call_async()")
+        fut = asyncio.run_coroutine_threadsafe(self._call(_cmd_parts(server_cmd), tool, params, timeout), loop)
+        try:
+            return fut.result(timeout + self.start_timeout)
+        except concurrent.futures.TimeoutError:
+            fut.cancel()
+            raise TimeoutError(f"MCP tool {tool} timed out after {timeout}s")
+
+    async def call_async(self, server_cmd, tool: str, params: Dict[str, Any] | None = None, timeout: float = 30) -> Any:
+        self._ensure_loop()
+        return await aio.on_loop(self._call(_cmd_parts(server_cmd), tool, params, timeout))
+
+    def run(self, coro, timeout: float | None = None) -> Any:
+        """Run a coroutine on the pool loop from a sync caller."""
+        self._ensure_loop()
+        return aio.run(coro, timeout)
+
+    def stats(self) -> Dict[str, Any]:
+        return {" ".join(k): {"alive": s.alive, "inflight": s.inflight, "idle_s": round(time.monotonic() - s.last_used, 1)}
+                for k, s in list(self._sessions.items())}
+
+    def close(self) -> None:
+        # The loop is shared with the rest of the pipeline: close the sessions, leave the loop running
+        with self._lock:
+            loop, reaper = self._loop, self._reaper_fut
+            self._loop = None
+        if loop is None or not loop.is_running():
+            return
+        if reaper is not None:
+            reaper.cancel()
+
+        async def _close_all():
+            for s in list(self._sessions.values()):
+                await s.close()
+            self._sessions.clear()
+
+        try:
+            asyncio.run_coroutine_threadsafe(_close_all(), loop).result(10)
+        except Exception:
+            logging.warning("MCP pool did not close cleanly")
+
+_pool: SessionPool | None = None
+_pool_lock = threading.Lock()
+
+def get_pool() -> SessionPool:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = SessionPool()
+            atexit.register(_pool.close)
+        return _pool
+
+async def _call_once(server_cmd, tool: str, params: Dict[str, Any] | None, timeout: float) -> Any:
+    # Unpooled path: spawn, initialize, call, shut down
+    from mcp import ClientSession, StdioServerParameters  # type: ignore
+    from mcp.client.stdio import stdio_client  # type: ignore
+    cmd_parts = _cmd_parts(server_cmd)
+    params_ = StdioServerParameters(command=cmd_parts[0], args=cmd_parts[1:], env=dict(os.environ))
+    async with stdio_client(params_) as (read, write):
+        async with ClientSession(read, write) as session:
+            await session.initialize()
+            return await asyncio.wait_for(session.call_tool(tool, params or {}), timeout)
+
+def _mcp_installed() -> bool:
     try:
         # Optional import; succeed only if mcp is installed
-        from mcp import ClientSession  # type: ignore
-        from mcp.transport.stdio import StdioServerTransport  # type: ignore
+        import mcp  # type: ignore  # noqa: F401
+        return True
     except Exception:
+        return False
+
+def call_tool(server_cmd: str, tool: str, params: Dict[str, Any] | None = None, timeout: int = 30) -> Dict[str, Any] | str:
+    if not _mcp_installed():
         return _no_mcp("MCP library not installed")
+    try:
+        if _pool_enabled():
+            return _normalize_result(get_pool().call(server_cmd, tool, params, timeout))
+        return _normalize_result(asyncio.run(_call_once(server_cmd, tool, params, timeout)))
+    except Exception as e:
+        return _no_mcp(f"MCP error: {e}")
 
-    async def _run() -> Dict[str, Any] | str:
-        cmd_parts = server_cmd if isinstance(server_cmd, (list, tuple)) else server_cmd.split()
-        async with StdioServerTransport.create(cmd_parts[0], *cmd_parts[1:]) as transport:
-            async with ClientSession(transport) as session:
-                await session.initialize()
-                try:
-                    res = await session.call_tool(tool, params or {})
-                    # Normalize a simple text/image response shape
-                    if hasattr(res, "content") and isinstance(res.content, list):
-                        text_chunks = []
-                        for c in res.content:
-                            t = getattr(c, "text", None)
-                            if t:
-                                text_chunks.append(t)
-                        return {"text": "\n".join(text_chunks)}
-                    return res  # best-effort passthrough
-                finally:
-                    await session.shutdown()
+async def call_tool_async(server_cmd: str, tool: str, params: Dict[str, Any] | None = None, timeout: int = 30) -> Dict[str, Any] | str:
+    if not _mcp_installed():
+        return _no_mcp("MCP library not installed")
     try:
-        if anyio is not None:
-            return anyio.run(_run)
-        return asyncio.run(_run())
+        if _pool_enabled():
+            return _normalize_result(await get_pool().call_async(server_cmd, tool, params, timeout))
+        return _normalize_result(await _call_once(server_cmd, tool, params, timeout))
     except Exception as e:
         return _no_mcp(f"MCP error: {e}")
 
 def _save_base64_png(b64: str, out_path: str) -> str | None:
     try:
         import base64
+        from .cache import write_atomic
         data = base64.b64decode(b64)
-        d = os.path.dirname(out_path)
-        if d and not os.path.exists(d):
-            os.makedirs(d, exist_ok=True)
-        with open(out_path, "wb") as f:
-            f.write(data)
-        return out_path
+        return write_atomic(out_path, data)
     except Exception:
         return None
 
@@ -116,3 +361,75 @@ def aws_docs_recommend(url: str) -> Dict[str, Any] | str:
     if not cmd:
         return _no_mcp("AWS_DOCS_MCP_CMD not set")
     return call_tool(cmd, "recommend", {"url": url})
+
+_URL_RE = re.compile(r"https?://[^\s<>\"'()\[\]]+")
+
+def _result_text(res: Any) -> str:
+    if isinstance(res, dict):
+        return "" if res.get("error") else str(res.get("text") or "")
+    return res if isinstance(res, str) else ""
+
+def _urls(res: Any, limit: int) -> list:
+    urls = []
+    for u in _URL_RE.findall(_result_text(res)):
+        u = u.rstrip(".,;:")
+        if u not in urls:
+            urls.append(u)
+        if len(urls) >= limit:
+            break
+    return urls
+
+async def _gather_until(coros: list, t_end: float) -> list:
+    # Results in input order; anything unfinished at t_end is cancelled and yields None
+    loop = asyncio.get_running_loop()
+    tasks = [asyncio.ensure_future(c) for c in coros]
+    if not tasks:
+        return []
+    done, pending = await asyncio.wait(tasks, timeout=max(0.0, t_end - loop.time()))
+    for t in pending:
+        t.cancel()
+    out = []
+    for t in tasks:
+        out.append(t.result() if t in done and not t.cancelled() and t.exception() is None else None)
+    return out
+
+async def aws_docs_fetch_many_async(queries: list, per_query: int = 1, deadline: float | None = None) -> list:
+    """Search all queries concurrently, dedupe the result URLs and read the pages concurrently.
+
+    Returns [{"query", "url", "text"}] in query order. Whatever has not finished when the
+    overall deadline (AWS_DOCS_DEADLINE seconds) passes is dropped.
+    """
+    cmd = os.environ.get("AWS_DOCS_MCP_CMD")
+    if not cmd or not queries:
+        return []
+    deadline = deadline if deadline is not None else env_float("AWS_DOCS_DEADLINE", 20)
+    loop = asyncio.get_running_loop()
+    t0 = loop.time()
+    t_end = t0 + deadline
+    searches = await _gather_until([call_tool_async(cmd, "search_documentation", {"query": q}, timeout=deadline) for q in queries], t_end)
+    targets = []
+    seen = set()
+    for q, res in zip(queries, searches):
+        for u in _urls(res, per_query):
+            if u not in seen:
+                seen.add(u)
+                targets.append((q, u))
+    remaining = max(0.0, t_end - loop.time())
+    pages = await _gather_until([call_tool_async(cmd, "read_documentation", {"url": u}, timeout=remaining) for _, u in targets], t_end)
+    out = []
+    for (q, u), page in zip(targets, pages):
+        text = _result_text(page)
+        if text:
+            out.append({"query": q, "url": u, "text": text})
+    logging.info("AWS docs batch: %d queries, %d urls, %d pages in %.2fs", len(queries), len(targets), len(out), loop.time() - t0)
+    return out
+
+def aws_docs_fetch_many(queries: list, per_query: int = 1, deadline: float | None = None) -> list:
+    if not os.environ.get("AWS_DOCS_MCP_CMD") or not queries or not _mcp_installed():
+        return []
+    deadline = deadline if deadline is not None else env_float("AWS_DOCS_DEADLINE", 20)
+    try:
+        return aio.run(aws_docs_fetch_many_async(queries, per_query, deadline), timeout=deadline + 5)
+    except Exception as e:
+        logging.warning("AWS docs batch failed: %s", e)
+        return []
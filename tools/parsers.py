@@ -1,23 +1,99 @@
 import os
-import pandas as pd
+import copy
+import time
+import logging
+from .cache import ContentCache, cache_root, file_digest, sha256_bytes
+from .env import env_flag, env_int
 
-def parse_pdf(path):
+# Bump whenever a parser's output shape or content changes so stale cache entries are ignored
+PARSER_VERSION = "5"
+
+def _extract_budget():
+    # Characters kept per document; 0 extracts everything
+    return max(0, env_int("DOC_EXTRACT_MAX_CHARS", 5000))
+
+def _pdf_pages_text(path, start, end):
+    from pypdf import PdfReader
+    reader = PdfReader(path)
+    return [reader.pages[i].extract_text() or "" for i in range(start, end)]
+
+def _pdf_text_parallel(path, total, workers):
+    import concurrent.futures
+    step = -(-total // workers)
+    ranges = [(i, min(total, i + step)) for i in range(0, total, step)]
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        chunks = pool.map(_pdf_pages_text, [path] * len(ranges), [r[0] for r in ranges], [r[1] for r in ranges])
+        return [t for chunk in chunks for t in chunk]
+
+def parse_pdf(path, max_chars=None, workers=None):
+    budget = _extract_budget() if max_chars is None else max_chars
+    workers = workers if workers is not None else env_int("PDF_EXTRACT_WORKERS", 1)
+    t0 = time.perf_counter()
+    name = os.path.basename(path)
     try:
         from pypdf import PdfReader
         reader = PdfReader(path)
-        text = "\n".join(page.extract_text() or "" for page in reader.pages)
-        return {"pdf": {"file": os.path.basename(path), "content": text[:5000]}}
-    except Exception:
-        return {"pdf": {"file": os.path.basename(path), "content": ""}}
+        total = len(reader.pages)
+        pages = None
+        if not budget and workers > 1 and total >= 2 * workers:
+            # Full text requested: split the page range across processes
+            try:
+                pages = _pdf_text_parallel(path, total, workers)
+            except Exception as e:
+                # Spawn failures and broken pools fall back to extracting in this process
+                logging.warning("Parallel PDF extraction failed for %s, extracting serially: %s", name, e)
+        if pages is None:
+            # Stream pages and stop as soon as the budget is filled
+            pages = []
+            size = 0
+            for page in reader.pages:
+                t = page.extract_text() or ""
+                pages.append(t)
+                size += len(t) + 1
+                if budget and size >= budget:
+                    break
+        text = "\n".join(pages)
+        ms = round((time.perf_counter() - t0) * 1000, 1)
+        logging.info("Extracted %s: %d/%d pages in %.1f ms", name, len(pages), total, ms)
+        return {"pdf": {"file": name, "content": text[:budget] if budget else text, "pages_read": len(pages), "pages_total": total, "extract_ms": ms}}
+    except Exception as e:
+        return {"pdf": {"file": name, "content": "", "error": f"{type(e).__name__}: {e}"}}
+
+_W = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
 
-def parse_docx(path):
+def parse_docx(path, max_chars=None):
+    budget = _extract_budget() if max_chars is None else max_chars
+    t0 = time.perf_counter()
+    name = os.path.basename(path)
     try:
-        import docx
-        doc = docx.Document(path)
-        text = "\n".join(p.text for p in doc.paragraphs)
-        return {"docx": {"file": os.path.basename(path), "content": text[:5000]}}
-    except Exception:
-        return {"docx": {"file": os.path.basename(path), "content": ""}}
+        import zipfile
+        from xml.etree.ElementTree import iterparse
+        paras = []
+        size = 0
+        # Stream word/document.xml paragraph by paragraph instead of loading the whole document
+        with zipfile.ZipFile(path) as z, z.open("word/document.xml") as f:
+            buf = []
+            for event, el in iterparse(f, events=("end",)):
+                if el.tag == _W + "t":
+                    buf.append(el.text or "")
+                elif el.tag == _W + "tab":
+                    buf.append("\t")
+                elif el.tag in (_W + "br", _W + "cr"):
+                    buf.append("\n")
+                elif el.tag == _W + "p":
+                    t = "".join(buf)
+                    buf = []
+                    paras.append(t)
+                    size += len(t) + 1
+                    el.clear()
+                    if budget and size >= budget:
+                        break
+        text = "\n".join(paras)
+        ms = round((time.perf_counter() - t0) * 1000, 1)
+        logging.info("Extracted %s: %d paragraphs in %.1f ms", name, len(paras), ms)
+        return {"docx": {"file": name, "content": text[:budget] if budget else text, "paragraphs_read": len(paras), "extract_ms": ms}}
+    except Exception as e:
+        return {"docx": {"file": name, "content": "", "error": f"{type(e).__name__}: {e}"}}
 
 def read_text(path):
     with open(path, "r", encoding="utf-8", errors="ignore") as f:
@@ -32,13 +108,11 @@ def parse_analytic(path):
     name = os.path.basename(path)
     ext = os.path.splitext(name)[1].lower()
     if ext in [".csv"]:
-        df = pd.read_csv(path)
-        return {"analytics": {"file": name, "columns": list(df.columns), "rows": len(df)}}
+        from .profiler import profile_csv
+        return {"analytics": {"file": name, **profile_csv(path)}}
     if ext in [".json"]:
-        import json
-        with open(path, "r", encoding="utf-8", errors="ignore") as f:
-            obj = json.load(f)
-        return {"analytics": {"file": name, "keys": list(obj.keys())}}
+        from .profiler import profile_json
+        return {"analytics": {"file": name, **profile_json(path)}}
     return {"analytics": {"file": name, "content": read_text(path)[:1000]}}
 
 def parse_survey(path):
@@ -54,26 +128,85 @@ def parse_inputs(spec_file, analytics_files, survey_files):
         data.update(parse_survey(s))
     return data
 
+def _parse_file(f, full=False):
+    # full=True extracts the whole text (no character budget), for retrieval indexing
+    ext = os.path.splitext(f)[1].lower()
+    if ext in [".md", ".txt"]:
+        text = read_text(f)
+        return {"doc": {"file": os.path.basename(f), "content": text if full else text[:5000]}}
+    if ext == ".csv":
+        return parse_analytic(f)
+    if ext == ".json":
+        return parse_analytic(f)
+    if ext in [".xls", ".xlsx"]:
+        try:
+            from .profiler import profile_excel
+            return {"excel": {"file": os.path.basename(f), **profile_excel(f)}}
+        except Exception as e:
+            return {"excel": {"file": os.path.basename(f), "content": "", "error": f"{type(e).__name__}: {e}"}}
+    if ext == ".pdf":
+        return parse_pdf(f, max_chars=0 if full else None)
+    if ext == ".docx":
+        return parse_docx(f, max_chars=0 if full else None)
+    text = read_text(f)
+    return {"file": {"file": os.path.basename(f), "content": text if full else text[:2000]}}
+
+_parse_cache = None
+
+def _get_parse_cache():
+    global _parse_cache
+    if _parse_cache is None:
+        disk = os.path.join(cache_root(), "parse") if env_flag("PARSE_CACHE_DISK", True) else None
+        _parse_cache = ContentCache(
+            "parse",
+            max_items=env_int("PARSE_CACHE_ITEMS", 64),
+            disk_dir=disk,
+            max_disk_bytes=env_int("PARSE_CACHE_MAX_MB", 256) * 1024 * 1024,
+        )
+    return _parse_cache
+
+def _with_file_name(fragment, name):
+    # Cached fragments are shared between uploads with identical bytes; stamp the caller's file name
+    out = copy.deepcopy(fragment)
+    for v in out.values():
+        if isinstance(v, dict) and "file" in v:
+            v["file"] = name
+    return out
+
+def _usable(fragment):
+    # Failed extractions carry an error; caching them would pin the failure. Empty documents are cached.
+    return not any(isinstance(v, dict) and v.get("error") for v in fragment.values())
+
+def _cached(f, full):
+    if not env_flag("PARSE_CACHE", True):
+        return _parse_file(f, full)
+    try:
+        digest = file_digest(f)
+    except OSError:
+        return _parse_file(f, full)
+    ext = os.path.splitext(f)[1].lower()
+    budget = "full" if full else _extract_budget()
+    key = sha256_bytes(f"{PARSER_VERSION}|{budget}|{ext}|{digest}".encode("utf-8"))
+    cache = _get_parse_cache()
+    hit = cache.get(key)
+    if hit is None:
+        hit = _parse_file(f, full)
+        if _usable(hit):
+            cache.put(key, hit)
+    return _with_file_name(hit, os.path.basename(f))
+
+def parse_file_cached(f):
+    return _cached(f, False)
+
+def parse_file_full(f):
+    """Like parse_file_cached, but with the complete extracted text; cached under its own key."""
+    return _cached(f, True)
+
+def parse_cache_stats():
+    return _get_parse_cache().stats()
+
 def parse_any(files):
     data = {}
     for f in files or []:
-        ext = os.path.splitext(f)[1].lower()
-        if ext in [".md", ".txt"]:
-            data.update({"doc": {"file": os.path.basename(f), "content": read_text(f)[:5000]}})
-        elif ext == ".csv":
-            data.update(parse_analytic(f))
-        elif ext == ".json":
-            data.update(parse_analytic(f))
-        elif ext in [".xls", ".xlsx"]:
-            try:
-                df = pd.read_excel(f)
-                data.update({"excel": {"file": os.path.basename(f), "columns": list(df.columns), "rows": len(df)}})
-            except Exception:
-                data.update({"excel": {"file": os.path.basename(f), "content": ""}})
-        elif ext == ".pdf":
-            data.update(parse_pdf(f))
-        elif ext == ".docx":
-            data.update(parse_docx(f))
-        else:
-            data.update({"file": {"file": os.path.basename(f), "content": read_text(f)[:2000]}})
+        data.update(parse_file_cached(f))
     return data
@@ -1,5 +1,11 @@
-import requests
+import os
 import re
+import asyncio
+import logging
+from . import aio
+from .render_backends import get_backend
+from .cache import ContentCache, cache_root, link_or_copy, sha256_bytes, write_atomic
+from .env import env_flag, env_int
 
 AWS_PUML_BASE = "https://raw.githubusercontent.com/awslabs/aws-icons-for-plantuml/v20.0/dist"
 GCP_PUML_BASE = "https://raw.githubusercontent.com/davidholsgrove/gcp-icons-for-plantuml/master/dist"
@@ -77,25 +83,91 @@ def _alias_map(provider: str) -> dict:
         }
     return {}
 
+# Category of each icon macro in the pinned icon libraries; per-icon files live at <Base>/<Category>/<Macro>.puml
+AWS_ICON_CATEGORIES = {
+    "EC2": "Compute",
+    "Lambda": "Compute",
+    "ElasticLoadBalancing": "NetworkingContentDelivery",
+    "VPC": "NetworkingContentDelivery",
+    "Route53": "NetworkingContentDelivery",
+    "CloudFront": "NetworkingContentDelivery",
+    "SimpleStorageService": "Storage",
+    "RelationalDatabaseService": "Database",
+    "Aurora": "Database",
+    "DynamoDB": "Database",
+    "ElastiCache": "Database",
+    "APIGateway": "ApplicationIntegration",
+    "SimpleQueueService": "ApplicationIntegration",
+    "SimpleNotificationService": "ApplicationIntegration",
+    "ElasticKubernetesService": "Containers",
+    "ElasticContainerRegistry": "Containers",
+    "ElasticContainerService": "Containers",
+    "CloudWatch": "ManagementGovernance",
+    "SystemsManager": "ManagementGovernance",
+    "KeyManagementService": "SecurityIdentityCompliance",
+    "IdentityAccessManagement": "SecurityIdentityCompliance",
+    "OpenSearchService": "Analytics",
+    "Redshift": "Analytics",
+    "Glue": "Analytics",
+    "EMR": "Analytics",
+    "KinesisDataStreams": "Analytics",
+}
+
+GCP_ICON_CATEGORIES = {
+    "ComputeEngine": "Compute",
+    "KubernetesEngine": "Compute",
+    "CloudRun": "Serverless",
+    "CloudFunctions": "Serverless",
+    "CloudSQL": "Databases",
+    "Spanner": "Databases",
+    "Memorystore": "Databases",
+    "Firestore": "Databases",
+    "BigQuery": "Analytics",
+    "PubSub": "Analytics",
+    "Dataproc": "Analytics",
+    "Dataflow": "Analytics",
+    "CloudStorage": "Storage",
+    "CloudLoadBalancing": "Networking",
+    "VPCNetwork": "Networking",
+}
+
+# Every category bundle; used when a diagram references a macro we cannot place
+AWS_ALL_CATEGORIES = [
+    "Analytics", "ApplicationIntegration", "BusinessApplications", "Compute", "Containers", "Database",
+    "DeveloperTools", "EndUserComputing", "General", "InternetOfThings", "MachineLearning",
+    "ManagementGovernance", "MediaServices", "MigrationTransfer", "NetworkingContentDelivery",
+    "SecurityIdentityCompliance", "Storage",
+]
+GCP_ALL_CATEGORIES = [
+    "AIAndMachineLearning", "Analytics", "Compute", "Databases", "DeveloperTools", "ManagementTools",
+    "Networking", "Operations", "SecurityIdentityCompliance", "Storage", "Serverless",
+]
+
+_ICON_LIBS = {
+    "aws": {"var": "AWSPuml", "url": AWS_PUML_BASE, "common": "AWSCommon.puml", "icons": AWS_ICON_CATEGORIES, "all": AWS_ALL_CATEGORIES, "per_icon": True},
+    "gcp": {"var": "GCPPuml", "url": GCP_PUML_BASE, "common": "GCPCommon.puml", "icons": GCP_ICON_CATEGORIES, "all": GCP_ALL_CATEGORIES, "per_icon": False},
+}
+
 def _normalize_services(services: list[str] | None, text_hint: str, provider: str) -> list[str]:
     services = services or []
     aliases = _alias_map(provider)
-    found = set()
+    # Ordered set: the same inputs must always produce the same diagram source (render cache key)
+    found = {}
     src = (text_hint or "").lower()
     # Simple keyword scan
     for key, macro in aliases.items():
-        if re.search(rf"\\b{re.escape(key)}\\b", src):
-            found.add(macro)
+        if re.search(rf"\b{re.escape(key)}\b", src):
+            found[macro] = True
     # Map provided services to macros
     for s in services:
         k = (s or "").strip().lower()
         if k in aliases:
-            found.add(aliases[k])
+            found[aliases[k]] = True
         else:
             # Heuristic CamelCase
             macro = re.sub(r"[^a-zA-Z0-9]+", " ", k).title().replace(" ", "")
             if macro:
-                found.add(macro)
+                found[macro] = True
     # Fallback defaults
     if not found:
         if provider == "aws":
@@ -104,29 +176,69 @@ def _normalize_services(services: list[str] | None, text_hint: str, provider: st
             return ["CloudLoadBalancing", "ComputeEngine", "CloudSQL"]
     return list(found)
 
+def _icon_mirror_dir(provider: str) -> str | None:
+    root = os.environ.get("PLANTUML_ICON_MIRROR")
+    if not root:
+        return None
+    local = os.path.abspath(os.path.join(root, provider))
+    if os.path.exists(os.path.join(local, _ICON_LIBS[provider]["common"])):
+        return local.replace("\\", "/")
+    logging.warning("PLANTUML_ICON_MIRROR has no %s icons at %s; using %s", provider, local, _ICON_LIBS[provider]["url"])
+    return None
+
+def _icon_files(provider: str, macros: list[str]) -> list[str]:
+    """Library-relative .puml files needed to draw macros: per-icon files or, failing that, category bundles."""
+    lib = _ICON_LIBS[provider]
+    mode = (os.environ.get("PLANTUML_ICON_INCLUDES") or "icon").strip().lower()
+    if any(m not in lib["icons"] for m in macros):
+        cats = lib["all"]
+        return [lib["common"]] + [f"{c}/all.puml" for c in cats]
+    if mode == "icon" and lib["per_icon"]:
+        return [lib["common"]] + [f"{lib['icons'][m]}/{m}.puml" for m in macros]
+    cats = list(dict.fromkeys(lib["icons"][m] for m in macros))
+    return [lib["common"]] + [f"{c}/all.puml" for c in cats]
+
+def _icon_includes(provider: str, macros: list[str]) -> list[str]:
+    lib = _ICON_LIBS[provider]
+    local = _icon_mirror_dir(provider)
+    # Remote GCP bundles are pulled with !includeurl; local mirror files are plain includes
+    directive = "!include" if (local or provider == "aws") else "!includeurl"
+    lines = [f"!define {lib['var']} {local or lib['url']}"]
+    lines += [f"{directive} {lib['var']}/{f}" for f in _icon_files(provider, macros)]
+    return lines
+
+def sync_icon_mirror(dest: str | None = None, providers: tuple = ("aws", "gcp"), timeout: int = 30) -> dict:
+    """Download the pinned icon files into dest (default PLANTUML_ICON_MIRROR) for offline rendering.
+
+    Fetches each library's common file, every category bundle and, where the library has them,
+    the per-icon files for known macros. Returns {provider: files written}.
+    """
+    import requests
+    dest = dest or os.environ.get("PLANTUML_ICON_MIRROR")
+    if not dest:
+        raise ValueError("no mirror directory: pass dest or set PLANTUML_ICON_MIRROR")
+    written = {}
+    with requests.Session() as http:
+        for provider in providers:
+            lib = _ICON_LIBS[provider]
+            files = [lib["common"]] + [f"{c}/all.puml" for c in lib["all"]]
+            if lib["per_icon"]:
+                files += [f"{c}/{m}.puml" for m, c in lib["icons"].items()]
+            count = 0
+            for rel in files:
+                r = http.get(f"{lib['url']}/{rel}", timeout=timeout)
+                if r.status_code != 200:
+                    logging.warning("Icon mirror: %s/%s returned HTTP %s", provider, rel, r.status_code)
+                    continue
+                write_atomic(os.path.join(dest, provider, *rel.split("/")), r.content)
+                count += 1
+            written[provider] = count
+    return written
+
 def build_cloud_arch_puml(provider: str, services: list[str] | None = None, text_hint: str = "") -> str:
-    if provider == "aws":
+    if provider in _ICON_LIBS:
         macros = _normalize_services(services, text_hint, provider)
-        includes = [
-            f"!define AWSPuml {AWS_PUML_BASE}",
-            "!include AWSPuml/AWSCommon.puml",
-            "!include AWSPuml/Analytics/all.puml",
-            "!include AWSPuml/ApplicationIntegration/all.puml",
-            "!include AWSPuml/BusinessApplications/all.puml",
-            "!include AWSPuml/Compute/all.puml",
-            "!include AWSPuml/Database/all.puml",
-            "!include AWSPuml/DeveloperTools/all.puml",
-            "!include AWSPuml/EndUserComputing/all.puml",
-            "!include AWSPuml/General/all.puml",
-            "!include AWSPuml/InternetOfThings/all.puml",
-            "!include AWSPuml/MachineLearning/all.puml",
-            "!include AWSPuml/ManagementGovernance/all.puml",
-            "!include AWSPuml/MediaServices/all.puml",
-            "!include AWSPuml/MigrationTransfer/all.puml",
-            "!include AWSPuml/NetworkingContentDelivery/all.puml",
-            "!include AWSPuml/SecurityIdentityCompliance/all.puml",
-            "!include AWSPuml/Storage/all.puml",
-        ]
+        includes = _icon_includes(provider, macros)
         nodes = []
         aliases = []
         for i, m in enumerate(macros):
@@ -138,45 +250,98 @@ def build_cloud_arch_puml(provider: str, services: list[str] | None = None, text
             edges.append(f"{aliases[i]} --> {aliases[i+1]}")
         content = "\n".join(nodes + edges)
         return "@startuml\n" + "\n".join(includes) + "\nleft to right direction\n" + content + "\n@enduml"
-    if provider == "gcp":
-        macros = _normalize_services(services, text_hint, provider)
-        includes = [
-            f"!define GCPPuml {GCP_PUML_BASE}",
-            "!includeurl GCPPuml/GCPCommon.puml",
-            "!includeurl GCPPuml/AIAndMachineLearning/all.puml",
-            "!includeurl GCPPuml/Analytics/all.puml",
-            "!includeurl GCPPuml/Compute/all.puml",
-            "!includeurl GCPPuml/Databases/all.puml",
-            "!includeurl GCPPuml/DeveloperTools/all.puml",
-            "!includeurl GCPPuml/ManagementTools/all.puml",
-            "!includeurl GCPPuml/Networking/all.puml",
-            "!includeurl GCPPuml/Operations/all.puml",
-            "!includeurl GCPPuml/SecurityIdentityCompliance/all.puml",
-            "!includeurl GCPPuml/Storage/all.puml",
-            "!includeurl GCPPuml/Serverless/all.puml",
-        ]
-        nodes = []
-        aliases = []
-        for i, m in enumerate(macros):
-            alias = f"n{i}"
-            aliases.append(alias)
-            nodes.append(f'{m}({alias}, "{m}")')
-        edges = []
-        for i in range(len(aliases) - 1):
-            edges.append(f"{aliases[i]} --> {aliases[i+1]}")
-        content = "\n".join(nodes + edges)
-        return "@startuml\n" + "\n".join(includes) + "\ndirected left to right\n" + content + "\n@enduml"
     # Fallback generic
     return "@startuml\nrectangle Cloud\n@enduml"
 
+_render_cache = None
+
+def _get_render_cache():
+    global _render_cache
+    if _render_cache is None:
+        _render_cache = ContentCache(
+            "render",
+            max_items=env_int("RENDER_CACHE_ITEMS", 64),
+            disk_dir=os.path.join(cache_root(), "render"),
+            max_disk_bytes=env_int("RENDER_CACHE_MAX_MB", 512) * 1024 * 1024,
+            dumps=bytes,
+            loads=bytes,
+        )
+    return _render_cache
+
+def _render_cache_enabled():
+    return env_flag("RENDER_CACHE", True)
+
+def _render_key(backend, uml_text, fmt):
+    return sha256_bytes(f"{backend.name}|{fmt}|".encode("utf-8") + uml_text.encode("utf-8"))
+
+def _materialize(cache, key, data, path):
+    # Prefer a hard link to the cached blob; fall back to writing the bytes
+    blob = cache.disk_path(key)
+    if blob:
+        try:
+            return link_or_copy(blob, path)
+        except OSError:
+            pass
+    return write_atomic(path, data)
+
+def _lookup(backend, items, fmt):
+    cache = _get_render_cache() if _render_cache_enabled() else None
+    keys = [_render_key(backend, t, fmt) for t, _ in items]
+    blobs = [cache.get(k) if cache else None for k in keys]
+    todo = [i for i, b in enumerate(blobs) if not b]
+    # Render each distinct missing source once
+    uniq = list(dict.fromkeys(keys[i] for i in todo))
+    src = {keys[i]: items[i][0] for i in todo}
+    return cache, keys, blobs, uniq, [src[k] for k in uniq]
+
+def _store(backend, cache, items, keys, blobs, fresh):
+    for k, data in fresh.items():
+        if data and cache:
+            cache.put(k, data)
+    out = []
+    for i, (_, path) in enumerate(items):
+        data = blobs[i] or fresh.get(keys[i])
+        try:
+            if data:
+                out.append(_materialize(cache, keys[i], data, path) if cache else write_atomic(path, data))
+                continue
+        except Exception:
+            logging.exception("Could not write %s", path)
+        out.append(None)
+    hits = sum(1 for b in blobs if b)
+    logging.info("PlantUML %s: %d/%d diagrams, %d rendered, %d from cache; %s", backend.name, sum(1 for p in out if p), len(out), len(fresh), hits, backend.stats())
+    return out
+
+def render_many(items, fmt="png"):
+    """Render [(uml_text, output_path), ...] on the configured backend; returns paths (None where rendering failed).
+
+    Identical sources are served from a content-addressed cache keyed by source, format and backend.
+    """
+    items = list(items)
+    if not items:
+        return []
+    backend = get_backend()
+    cache, keys, blobs, uniq, texts = _lookup(backend, items, fmt)
+    fresh = dict(zip(uniq, backend.render_many(texts, fmt))) if uniq else {}
+    return _store(backend, cache, items, keys, blobs, fresh)
+
+async def arender_many(items, fmt="png"):
+    """render_many() for async callers: renders run on the shared event loop, cache and file I/O on a worker thread."""
+    items = list(items)
+    if not items:
+        return []
+    backend = get_backend()
+    cache, keys, blobs, uniq, texts = await asyncio.to_thread(_lookup, backend, items, fmt)
+    fresh = dict(zip(uniq, await aio.on_loop(backend.arender_many(texts, fmt)))) if uniq else {}
+    return await asyncio.to_thread(_store, backend, cache, items, keys, blobs, fresh)
+
 def render_png(uml_text, output_path):
     try:
-        url = "https://www.plantuml.com/plantuml/png"
-        r = requests.post(url, data=uml_text.encode("utf-8"), timeout=30)
-        if r.status_code == 200:
-            with open(output_path, "wb") as f:
-                f.write(r.content)
-            return output_path
-        return None
+        return render_many([(uml_text, output_path)])[0]
     except Exception:
         return None
+
+def render_stats():
+    stats = get_backend().stats()
+    stats["cache"] = _get_render_cache().stats()
+    return stats
@@ -0,0 +1,400 @@
+import os
+import json
+import time
+import logging
+import numpy as np
+import pandas as pd
+from .env import env_int
+
+# Distinct values are estimated with a k-minimum-values sketch: exact below K, ~6% error above
+KMV_K = 256
+
+def _kind(series):
+    if pd.api.types.is_bool_dtype(series):
+        return "bool"
+    if pd.api.types.is_integer_dtype(series):
+        return "int"
+    if pd.api.types.is_float_dtype(series):
+        return "float"
+    if pd.api.types.is_datetime64_any_dtype(series):
+        return "datetime"
+    return "string"
+
+def _canonical(part, kind):
+    # The sketch hashes a text form that does not depend on the dtype a chunk was read with:
+    # 1 from an int chunk, 1.0 from a float chunk and "1" from an object chunk all hash alike
+    if kind in ("int", "float"):
+        return part.astype("float64").astype(str)
+    return part.astype(str)
+
+class ColumnProfile:
+    """Bounded-memory running summary of one column: type counts, nulls, numeric range and a KMV sketch."""
+
+    def __init__(self):
+        self.nulls = 0
+        self.kinds = {}
+        self.min = None
+        self.max = None
+        self._sketch = np.empty(0, dtype=np.uint64)
+
+    def add(self, series):
+        values = series.dropna()
+        self.nulls += int(len(series) - len(values))
+        if values.empty:
+            return
+        if pd.api.types.is_numeric_dtype(values) or pd.api.types.is_datetime64_any_dtype(values):
+            parts = [values]
+        else:
+            # Object chunks of a mixed column: count numbers and text per value, so the
+            # column's type and range come out the same however it is chunked
+            numeric = pd.to_numeric(values, errors="coerce").notna()
+            parts = [pd.to_numeric(values[numeric]), values[~numeric]]
+        for part in parts:
+            if part.empty:
+                continue
+            kind = _kind(part)
+            self.kinds[kind] = self.kinds.get(kind, 0) + len(part)
+            if kind in ("int", "float"):
+                lo, hi = part.min(), part.max()
+                self.min = lo if self.min is None else min(self.min, lo)
+                self.max = hi if self.max is None else max(self.max, hi)
+            hashes = pd.util.hash_pandas_object(_canonical(part, kind), index=False).to_numpy(dtype=np.uint64)
+            self._sketch = np.unique(np.concatenate([self._sketch, hashes]))[:KMV_K]
+
+    def distinct_estimate(self):
+        n = len(self._sketch)
+        if n < KMV_K:
+            return n
+        return int((KMV_K - 1) / (float(self._sketch[-1]) / 2.0 ** 64))
+
+    def summary(self, rows):
+        counts = {k: n for k, n in self.kinds.items() if k not in ("int", "float")}
+        numeric = self.kinds.get("int", 0) + self.kinds.get("float", 0)
+        if numeric:
+            # Whole-column decision: any float makes the column float
+            counts["float" if "float" in self.kinds else "int"] = numeric
+        kind = max(counts, key=counts.get) if counts else "empty"
+        out = {"type": kind, "null_rate": round(self.nulls / rows, 4) if rows else 0.0, "distinct_est": self.distinct_estimate()}
+        if self.min is not None and kind in ("int", "float"):
+            out["min"] = self.min.item() if hasattr(self.min, "item") else self.min
+            out["max"] = self.max.item() if hasattr(self.max, "item") else self.max
+        return out
+
+def _labels(columns):
+    # Unique profile keys for repeated header names, numbered the way pandas does ("a", "a.1", ...)
+    seen = {}
+    out = []
+    for c in columns:
+        n = seen.get(c, 0)
+        seen[c] = n + 1
+        out.append(c if not n else f"{c}.{n}")
+    return out
+
+class TableProfiler:
+    """Feeds DataFrame chunks into per-column profiles; only the first PROFILE_MAX_COLUMNS columns are profiled.
+
+    Profiles are kept by column position, so repeated header names stay separate columns.
+    """
+
+    def __init__(self, columns, max_columns=None):
+        self.columns = [str(c) for c in columns]
+        self.max_columns = max_columns if max_columns is not None else env_int("PROFILE_MAX_COLUMNS", 100)
+        self.rows = 0
+        self._cols = [ColumnProfile() for _ in self.columns[: self.max_columns]]
+
+    def add(self, df):
+        self.rows += len(df)
+        for i in range(min(len(self._cols), df.shape[1])):
+            self._cols[i].add(df.iloc[:, i])
+
+    def result(self):
+        labels = _labels(self.columns)
+        return {"columns": self.columns, "rows": self.rows, "profile": {labels[i]: p.summary(self.rows) for i, p in enumerate(self._cols)}}
+
+def profile_csv(path, chunk_rows=None):
+    chunk_rows = chunk_rows or env_int("PROFILE_CHUNK_ROWS", 50000)
+    t0 = time.perf_counter()
+    header = pd.read_csv(path, nrows=0).columns
+    prof = TableProfiler(header)
+    for chunk in pd.read_csv(path, chunksize=chunk_rows, low_memory=True):
+        prof.add(chunk)
+    out = prof.result()
+    out["profile_ms"] = round((time.perf_counter() - t0) * 1000, 1)
+    logging.info("Profiled %s: %d rows x %d columns in %.1f ms", os.path.basename(path), out["rows"], len(out["columns"]), out["profile_ms"])
+    return out
+
+def profile_excel(path, chunk_rows=None):
+    """Profile the first sheet. .xlsx is streamed with read-only openpyxl; legacy .xls goes through pandas."""
+    chunk_rows = chunk_rows or env_int("PROFILE_CHUNK_ROWS", 50000)
+    t0 = time.perf_counter()
+    if path.lower().endswith(".xls"):
+        df = pd.read_excel(path)
+        prof = TableProfiler(df.columns)
+        prof.add(df)
+    else:
+        from openpyxl import load_workbook
+        wb = load_workbook(path, read_only=True, data_only=True)
+        try:
+            ws = wb.worksheets[0]
+            rows = ws.iter_rows(values_only=True)
+            header = next(rows, None) or ()
+            columns = [str(h) if h is not None else f"Unnamed: {i}" for i, h in enumerate(header)]
+            prof = TableProfiler(columns)
+            n = len(columns)
+            batch = []
+            for r in rows:
+                batch.append(tuple(r[:n]) + (None,) * (n - len(r)))
+                if len(batch) >= chunk_rows:
+                    prof.add(pd.DataFrame(batch, columns=columns))
+                    batch = []
+            if batch:
+                prof.add(pd.DataFrame(batch, columns=columns))
+        finally:
+            wb.close()
+    out = prof.result()
+    out["profile_ms"] = round((time.perf_counter() - t0) * 1000, 1)
+    logging.info("Profiled %s: %d rows x %d columns in %.1f ms", os.path.basename(path), out["rows"], len(out["columns"]), out["profile_ms"])
+    return out
+
+_WS = " \t\r\n"
+
+class _JsonTruncated(Exception):
+    pass
+
+class _JsonReader:
+    """Sliding text window over a file: reads at most max_bytes and never buffers more than one element past max_element."""
+
+    def __init__(self, f, max_bytes, max_element, stats):
+        import codecs
+        self.f = f
+        self.max_bytes = max_bytes
+        self.max_element = max_element
+        self.stats = stats
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+        self.json = json.JSONDecoder()
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        if self.eof:
+            return False
+        if self.stats["bytes_read"] >= self.max_bytes:
+            self.eof = True
+            self.stats["truncated"] = True
+            return False
+        block = self.f.read(min(1 << 20, self.max_bytes - self.stats["bytes_read"]))
+        if not block:
+            self.eof = True
+            return False
+        self.stats["bytes_read"] += len(block)
+        self.buf = self.buf[self.pos:] + self.decoder.decode(block)
+        self.pos = 0
+        return True
+
+    def peek(self):
+        while True:
+            n = len(self.buf)
+            while self.pos < n and self.buf[self.pos] in _WS:
+                self.pos += 1
+            if self.pos < n:
+                return self.buf[self.pos]
+            if not self.fill():
+                return ""
+
+    def value(self):
+        """Decode the next complete value (C decoder); grows the window until it fits or a limit is hit."""
+        while True:
+            self.peek()
+            try:
+                value, end = self.json.raw_decode(self.buf, self.pos)
+                decoded = True
+            except json.JSONDecodeError:
+                decoded = False
+            # A number at the very end of the window may continue in the next block
+            if decoded and (end < len(self.buf) or self.eof):
+                self.pos = end
+                return value
+            if len(self.buf) - self.pos > self.max_element:
+                self.stats["truncated"] = True
+                raise _JsonTruncated()
+            if not self.fill():
+                if decoded and not self.stats["truncated"]:
+                    self.pos = end
+                    return value
+                # Input ended inside a value: budget reached or malformed document
+                self.stats["truncated"] = True
+                raise _JsonTruncated()
+
+class _SchemaBuilder:
+    """Bounded schema: per node the observed types, object keys, array length range and a few sample values."""
+
+    def __init__(self, max_depth, max_nodes, max_keys=100, samples=3):
+        self.max_depth = max_depth
+        self.max_nodes = max_nodes
+        self.max_keys = max_keys
+        self.samples = samples
+        self.nodes = 0
+        self.root = self.node()
+
+    def node(self):
+        if self.nodes >= self.max_nodes:
+            return None
+        self.nodes += 1
+        return {"types": {}, "keys": {}, "items": None, "len": None, "samples": []}
+
+    def child(self, parent, key=None):
+        if parent is None:
+            return None
+        if key is None:
+            if parent["items"] is None:
+                parent["items"] = self.node()
+            return parent["items"]
+        c = parent["keys"].get(key)
+        if c is None and len(parent["keys"]) < self.max_keys:
+            c = parent["keys"][key] = self.node()
+        return c
+
+    def mark(self, node, t, sample=None):
+        if node is None:
+            return
+        node["types"][t] = node["types"].get(t, 0) + 1
+        if sample is not None and len(node["samples"]) < self.samples and sample not in node["samples"]:
+            node["samples"].append(sample)
+
+    def length(self, node, n):
+        if node is None:
+            return
+        ln = node["len"]
+        node["len"] = [n, n, n, 1] if ln is None else [min(ln[0], n), max(ln[1], n), ln[2] + n, ln[3] + 1]
+
+    def add(self, node, value, depth):
+        if node is None:
+            return
+        if isinstance(value, dict):
+            self.mark(node, "object")
+            if depth < self.max_depth:
+                for k, v in value.items():
+                    self.add(self.child(node, k), v, depth + 1)
+        elif isinstance(value, list):
+            self.mark(node, "array")
+            self.length(node, len(value))
+            if depth < self.max_depth and value:
+                item = self.child(node)
+                for v in value:
+                    self.add(item, v, depth + 1)
+        elif isinstance(value, bool):
+            self.mark(node, "boolean", "true" if value else "false")
+        elif isinstance(value, int):
+            self.mark(node, "integer", value)
+        elif isinstance(value, float):
+            self.mark(node, "number", value)
+        elif isinstance(value, str):
+            self.mark(node, "string", value[:40])
+        else:
+            self.mark(node, "null")
+
+    def result(self, node=None):
+        node = self.root if node is None else node
+        out = {"type": "|".join(sorted(node["types"], key=node["types"].get, reverse=True)) or "unknown"}
+        if node["keys"]:
+            out["keys"] = {k: self.result(v) for k, v in node["keys"].items() if v is not None}
+        if node["len"]:
+            lo, hi, total, count = node["len"]
+            out["length"] = {"min": lo, "max": hi, "avg": round(total / count, 1)}
+        if node["items"] is not None:
+            out["items"] = self.result(node["items"])
+        if node["samples"]:
+            out["samples"] = node["samples"]
+        return out
+
+def _stream_schema(reader, builder, stream_depth):
+    # Containers shallower than stream_depth are walked incrementally; anything deeper is decoded
+    # as one bounded value. That handles both [records...] and {"data": [records...]} dumps.
+    stack = []
+    top_values = 0
+    try:
+        while True:
+            c = reader.peek()
+            if not c:
+                break
+            top = stack[-1] if stack else None
+            if c == ",":
+                reader.pos += 1
+                continue
+            if top is not None and c in "]}":
+                reader.pos += 1
+                stack.pop()
+                if top["kind"] == "arr":
+                    builder.length(top["node"], top["count"])
+                if stack and stack[-1]["kind"] == "obj":
+                    stack[-1]["key"] = None
+                continue
+            if top is not None and top["kind"] == "obj" and top["key"] is None:
+                key = reader.value()
+                if reader.peek() != ":":
+                    reader.stats["truncated"] = True
+                    break
+                reader.pos += 1
+                top["key"] = str(key)
+                continue
+            if top is None:
+                top_values += 1
+                if top_values == 2:
+                    # Several top-level values (JSON Lines): describe them as an array of records
+                    wrapper = {"types": {"array": 1}, "keys": {}, "items": builder.root, "len": None, "samples": []}
+                    builder.root = wrapper
+                node = builder.root if top_values == 1 else builder.root["items"]
+            elif top["kind"] == "arr":
+                top["count"] += 1
+                node = builder.child(top["node"]) if len(stack) <= builder.max_depth else None
+            else:
+                node = builder.child(top["node"], top["key"]) if len(stack) <= builder.max_depth else None
+            depth = len(stack)
+            if c in "[{" and depth < stream_depth:
+                reader.pos += 1
+                builder.mark(node, "array" if c == "[" else "object")
+                stack.append({"kind": "arr" if c == "[" else "obj", "node": node, "count": 0, "key": None})
+                continue
+            builder.add(node, reader.value(), depth)
+            if top is not None and top["kind"] == "obj":
+                top["key"] = None
+    except _JsonTruncated:
+        pass
+    if stack:
+        reader.stats["truncated"] = True
+        # Report what was seen of arrays left open by a budget cut
+        for frame in stack:
+            if frame["kind"] == "arr":
+                builder.length(frame["node"], frame["count"])
+    return top_values
+
+def profile_json(path, max_bytes=None, max_depth=None, max_nodes=None):
+    """Infer a schema from a JSON (or JSON Lines) file without materializing the document.
+
+    JSON_PROFILE_MAX_BYTES caps how much is read; JSON_PROFILE_MAX_ELEMENT_BYTES caps the
+    largest single element held in memory; JSON_PROFILE_MAX_DEPTH / _MAX_NODES bound the schema.
+    """
+    max_bytes = max_bytes or env_int("JSON_PROFILE_MAX_BYTES", 64 * 1024 * 1024)
+    max_depth = max_depth or env_int("JSON_PROFILE_MAX_DEPTH", 6)
+    max_nodes = max_nodes or env_int("JSON_PROFILE_MAX_NODES", 2000)
+    max_element = env_int("JSON_PROFILE_MAX_ELEMENT_BYTES", 8 * 1024 * 1024)
+    t0 = time.perf_counter()
+    stats = {"bytes_read": 0, "truncated": False}
+    builder = _SchemaBuilder(max_depth, max_nodes)
+    top_values = 0
+    with open(path, "rb") as f:
+        reader = _JsonReader(f, max_bytes, max_element, stats)
+        top_values = _stream_schema(reader, builder, stream_depth=env_int("JSON_PROFILE_STREAM_DEPTH", 2))
+    if top_values > 1:
+        builder.root["len"] = [top_values, top_values, top_values, 1]
+    schema = builder.result()
+    out = {
+        "keys": list(schema.get("keys", {})),
+        "schema": schema,
+        "bytes_read": stats["bytes_read"],
+        "truncated": stats["truncated"] or builder.nodes >= max_nodes,
+        "profile_ms": round((time.perf_counter() - t0) * 1000, 1),
+    }
+    logging.info("Profiled %s: %d bytes, %d schema nodes in %.1f ms", os.path.basename(path), out["bytes_read"], builder.nodes, out["profile_ms"])
+    return out
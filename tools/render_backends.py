@@ -0,0 +1,260 @@
+import os
+import time
+import atexit
+import asyncio
+import queue
+import logging
+import threading
+import subprocess
+import concurrent.futures
+from typing import Any, Dict, List
+import httpx
+import requests
+from .env import env_float, env_int
+
+class RenderBackend:
+    """Turns PlantUML source into image bytes. Subclasses implement render(); latency is tracked here."""
+
+    name = "base"
+
+    def __init__(self, timeout: float = 30, workers: int = 4):
+        self.timeout = timeout
+        self.workers = max(1, int(workers))
+        self._lock = threading.Lock()
+        self._latencies: List[float] = []
+        self.renders = 0
+        self.failures = 0
+
+    def render(self, uml_text: str, fmt: str = "png") -> bytes | None:
+        raise NotImplementedError
+
+    async def arender(self, uml_text: str, fmt: str = "png") -> bytes | None:
+        # Backends without a native async path render on a worker thread
+        return await asyncio.to_thread(self.render, uml_text, fmt)
+
+    def _record(self, t0: float, data: bytes | None) -> None:
+        ms = (time.perf_counter() - t0) * 1000
+        with self._lock:
+            self.renders += 1
+            if not data:
+                self.failures += 1
+            self._latencies.append(ms)
+            del self._latencies[:-512]
+
+    def _timed(self, uml_text: str, fmt: str) -> bytes | None:
+        t0 = time.perf_counter()
+        try:
+            data = self.render(uml_text, fmt)
+        except Exception as e:
+            logging.warning("PlantUML %s render failed: %s", self.name, e)
+            data = None
+        self._record(t0, data)
+        return data
+
+    async def _atimed(self, uml_text: str, fmt: str, sem: asyncio.Semaphore) -> bytes | None:
+        async with sem:
+            t0 = time.perf_counter()
+            try:
+                data = await self.arender(uml_text, fmt)
+            except Exception as e:
+                logging.warning("PlantUML %s render failed: %s", self.name, e)
+                data = None
+            self._record(t0, data)
+            return data
+
+    def render_many(self, texts: List[str], fmt: str = "png") -> List[bytes | None]:
+        if len(texts) <= 1 or self.workers == 1:
+            return [self._timed(t, fmt) for t in texts]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(self.workers, len(texts)), thread_name_prefix="render") as pool:
+            return list(pool.map(lambda t: self._timed(t, fmt), texts))
+
+    async def arender_many(self, texts: List[str], fmt: str = "png") -> List[bytes | None]:
+        """render_many() on the running event loop, at most `workers` renders in flight."""
+        sem = asyncio.Semaphore(self.workers)
+        return list(await asyncio.gather(*(self._atimed(t, fmt, sem) for t in texts)))
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            last = self._latencies[-1] if self._latencies else None
+            lat = sorted(self._latencies)
+            renders, failures = self.renders, self.failures
+        pct = lambda q: round(lat[min(len(lat) - 1, int(q * len(lat)))], 1) if lat else None
+        return {"backend": self.name, "renders": renders, "failures": failures,
+                "p50_ms": pct(0.5), "p95_ms": pct(0.95), "last_ms": round(last, 1) if last is not None else None}
+
+    def close(self) -> None:
+        pass
+
+class HttpBackend(RenderBackend):
+    """POSTs source to a PlantUML server (public or self-hosted) over a keep-alive session.
+
+    Async renders use an httpx client bound to the event loop that first uses it.
+    """
+
+    def __init__(self, name: str, base_url: str, **kw):
+        super().__init__(**kw)
+        self.name = name
+        self.base_url = base_url.rstrip("/")
+        self._session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.workers)
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+        self._aclient = None
+        self._aclient_loop = None
+
+    def render(self, uml_text: str, fmt: str = "png") -> bytes | None:
+        r = self._session.post(f"{self.base_url}/{fmt}", data=uml_text.encode("utf-8"), timeout=self.timeout)
+        if r.status_code == 200:
+            return r.content
+        logging.warning("PlantUML %s returned HTTP %s", self.name, r.status_code)
+        return None
+
+    async def arender(self, uml_text: str, fmt: str = "png") -> bytes | None:
+        loop = asyncio.get_running_loop()
+        if self._aclient is None or self._aclient_loop is not loop:
+            limits = httpx.Limits(max_connections=self.workers, max_keepalive_connections=self.workers)
+            self._aclient = httpx.AsyncClient(timeout=self.timeout, limits=limits)
+            self._aclient_loop = loop
+        r = await self._aclient.post(f"{self.base_url}/{fmt}", content=uml_text.encode("utf-8"))
+        if r.status_code == 200:
+            return r.content
+        logging.warning("PlantUML %s returned HTTP %s", self.name, r.status_code)
+        return None
+
+    def close(self) -> None:
+        self._session.close()
+        client, loop = self._aclient, self._aclient_loop
+        self._aclient = None
+        if client is not None and loop.is_running():
+            asyncio.run_coroutine_threadsafe(client.aclose(), loop)
+
+class _PipeProcess:
+    """One warm `plantuml -pipe` process; diagrams are written to stdin and images read back up to a delimiter."""
+
+    DELIM = b"~~PLANTUML-END~~"
+
+    def __init__(self, cmd: List[str], fmt: str):
+        self.cmd = cmd + [f"-t{fmt}", "-pipe", "-pipedelimitor", self.DELIM.decode("ascii")]
+        self.proc = None
+        self._chunks: "queue.Queue[bytes]" = queue.Queue()
+        self._buf = b""
+
+    def _start(self) -> None:
+        self.proc = subprocess.Popen(self.cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        self._chunks = queue.Queue()
+        self._buf = b""
+        threading.Thread(target=self._pump, args=(self.proc, self._chunks), name="plantuml-pipe", daemon=True).start()
+        logging.info("Started PlantUML renderer: %s", " ".join(self.cmd))
+
+    @staticmethod
+    def _pump(proc: subprocess.Popen, chunks: "queue.Queue[bytes]") -> None:
+        # Blocking reads happen here so render() can wait on the queue with a timeout (works on Windows pipes too)
+        while True:
+            data = proc.stdout.read1(65536)
+            chunks.put(data)
+            if not data:
+                return
+
+    def render(self, uml_text: str, timeout: float) -> bytes:
+        if self.proc is None or self.proc.poll() is not None:
+            self._start()
+        text = uml_text if uml_text.endswith("\n") else uml_text + "\n"
+        try:
+            self.proc.stdin.write(text.encode("utf-8"))
+            self.proc.stdin.flush()
+            t_end = time.monotonic() + timeout
+            while self.DELIM not in self._buf:
+                data = self._chunks.get(timeout=max(0.0, t_end - time.monotonic()))
+                if not data:
+                    raise RuntimeError("renderer exited")
+                self._buf += data
+        except Exception:
+            # Output framing is unknown after a failure; start over with a fresh process
+            self.kill()
+            raise
+        image, _, self._buf = self._buf.partition(self.DELIM)
+        self._buf = self._buf.lstrip(b"\r\n")
+        return image.lstrip(b"\r\n")
+
+    def kill(self) -> None:
+        if self.proc is not None:
+            try:
+                self.proc.kill()
+            except Exception:
+                pass
+        self.proc = None
+
+class PipeBackend(RenderBackend):
+    """Long-lived local PlantUML processes kept warm so each diagram skips JVM startup."""
+
+    name = "pipe"
+
+    def __init__(self, cmd: List[str], **kw):
+        super().__init__(**kw)
+        self.cmd = cmd
+        self._idle: Dict[str, "queue.Queue[_PipeProcess]"] = {}
+        self._all: List[_PipeProcess] = []
+
+    def _idle_queue(self, fmt: str) -> "queue.Queue[_PipeProcess]":
+        with self._lock:
+            q = self._idle.get(fmt)
+            if q is None:
+                q = queue.Queue()
+                for _ in range(self.workers):
+                    p = _PipeProcess(self.cmd, fmt)
+                    self._all.append(p)
+                    q.put(p)
+                self._idle[fmt] = q
+            return q
+
+    def render(self, uml_text: str, fmt: str = "png") -> bytes | None:
+        q = self._idle_queue(fmt)
+        proc = q.get(timeout=self.timeout)
+        try:
+            return proc.render(uml_text, self.timeout) or None
+        finally:
+            q.put(proc)
+
+    def close(self) -> None:
+        for p in self._all:
+            p.kill()
+
+def _pipe_cmd() -> List[str]:
+    cmd = os.environ.get("PLANTUML_CMD")
+    if cmd:
+        return cmd.split()
+    jar = os.environ.get("PLANTUML_JAR", "plantuml.jar")
+    return ["java", "-Djava.awt.headless=true", "-jar", jar]
+
+_backend: RenderBackend | None = None
+_backend_key = None
+_backend_lock = threading.Lock()
+
+def _close_backend() -> None:
+    if _backend is not None:
+        _backend.close()
+
+atexit.register(_close_backend)
+
+def get_backend() -> RenderBackend:
+    """Backend selected by PLANTUML_BACKEND: remote (default), server (local PlantUML server) or pipe."""
+    global _backend, _backend_key
+    kind = (os.environ.get("PLANTUML_BACKEND") or "remote").strip().lower()
+    timeout = env_float("PLANTUML_TIMEOUT", 30)
+    workers = env_int("PLANTUML_WORKERS", 4)
+    if kind == "server":
+        key = (kind, os.environ.get("PLANTUML_LOCAL_URL") or "http://localhost:8080/plantuml", timeout, workers)
+    elif kind == "pipe":
+        key = (kind, tuple(_pipe_cmd()), timeout, env_int("PLANTUML_PIPE_WORKERS", 1))
+    else:
+        key = ("remote", os.environ.get("PLANTUML_SERVER_URL") or "https://www.plantuml.com/plantuml", timeout, workers)
+    with _backend_lock:
+        if _backend is None or _backend_key != key:
+            if _backend is not None:
+                _backend.close()
+            if key[0] == "pipe":
+                _backend = PipeBackend(list(key[1]), timeout=timeout, workers=key[3])
+            else:
+                _backend = HttpBackend(key[0], key[1], timeout=timeout, workers=workers)
+            _backend_key = key
+        return _backend
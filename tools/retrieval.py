@@ -0,0 +1,163 @@
+import os
+import re
+import math
+import logging
+import threading
+from collections import Counter, OrderedDict
+from typing import Dict, List, Tuple
+from .cache import file_digest
+from .env import env_flag, env_int
+
+_TOKEN_RE = re.compile(r"[a-z0-9][a-z0-9_\-\.]*[a-z0-9]|[a-z0-9]")
+_STOP = frozenset(
+    "a an and are as at be by can do for from has have how i in is it its me my of on or our should "
+    "so that the their this to us we what when which will with you your".split()
+)
+
+def tokenize(text: str) -> List[str]:
+    return [t for t in _TOKEN_RE.findall((text or "").lower()) if t not in _STOP]
+
+def chunk_text(text: str, size: int = 800) -> List[str]:
+    """Split text into chunks of at most ~size chars, preferring paragraph, then line, then word boundaries."""
+    chunks, buf = [], ""
+    for para in re.split(r"\n\s*\n|\n", text or ""):
+        para = para.strip()
+        if not para:
+            continue
+        while len(para) > size:
+            cut = para.rfind(" ", 0, size)
+            cut = cut if cut > size // 2 else size
+            if buf:
+                chunks.append(buf)
+                buf = ""
+            chunks.append(para[:cut].strip())
+            para = para[cut:].strip()
+        if buf and len(buf) + 1 + len(para) > size:
+            chunks.append(buf)
+            buf = ""
+        buf = f"{buf}\n{para}" if buf else para
+    if buf:
+        chunks.append(buf)
+    return chunks
+
+class ChunkIndex:
+    """In-process BM25 index over document chunks."""
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.chunks: List[Dict[str, object]] = []
+        self._postings: Dict[str, List[Tuple[int, int]]] = {}
+        self._lengths: List[int] = []
+
+    def add(self, label: str, file: str, text: str, size: int = 800) -> None:
+        for pos, chunk in enumerate(chunk_text(text, size)):
+            i = len(self.chunks)
+            terms = Counter(tokenize(chunk))
+            self.chunks.append({"label": label, "file": file, "pos": pos, "text": chunk})
+            self._lengths.append(sum(terms.values()))
+            for term, tf in terms.items():
+                self._postings.setdefault(term, []).append((i, tf))
+
+    def search(self, query: str, k: int | None = None) -> List[Tuple[float, int]]:
+        """(score, chunk index) pairs for chunks matching any query term, best first."""
+        n = len(self.chunks)
+        if not n:
+            return []
+        avgdl = (sum(self._lengths) / n) or 1.0
+        scores: Dict[int, float] = {}
+        for term in set(tokenize(query)):
+            postings = self._postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (n - len(postings) + 0.5) / (len(postings) + 0.5))
+            for i, tf in postings:
+                norm = tf + self.k1 * (1 - self.b + self.b * self._lengths[i] / avgdl)
+                scores[i] = scores.get(i, 0.0) + idf * tf * (self.k1 + 1) / norm
+        ranked = sorted(((s, i) for i, s in scores.items()), key=lambda x: (-x[0], x[1]))
+        return ranked[:k] if k else ranked
+
+    def pack(self, query: str, budget: int) -> str:
+        """Best-scoring chunks for query that fit in budget chars, grouped per file in document order."""
+        picked, used = [], 0
+        ranked = self.search(query)
+        for _, i in ranked:
+            size = len(self.chunks[i]["text"]) + 1
+            if used + size > budget:
+                continue
+            picked.append(i)
+            used += size
+        clip = {}
+        if not picked:
+            if not ranked or budget <= 0:
+                return ""
+            # Budget smaller than any matching chunk: send the head of the best one
+            picked = [ranked[0][1]]
+            clip[picked[0]] = budget
+        groups: "OrderedDict[Tuple[str, str], List[int]]" = OrderedDict()
+        for i in sorted(picked):
+            c = self.chunks[i]
+            groups.setdefault((c["label"], c["file"]), []).append(i)
+        parts = []
+        for (label, file), ids in groups.items():
+            body = "\n...\n".join(self.chunks[i]["text"][:clip.get(i)] for i in ids)
+            parts.append(f"[{label}] {file}:\n{body}")
+        return "\n\n".join(parts)
+
+_indexes: "OrderedDict[tuple, ChunkIndex]" = OrderedDict()
+_lock = threading.Lock()
+# One build at a time, so a warm-up and a first call on the same uploads do not both extract them
+_build_lock = threading.Lock()
+
+def retrieval_enabled() -> bool:
+    return env_flag("DOC_RETRIEVAL", True)
+
+def index_for(documents: List[str]) -> ChunkIndex:
+    """Chunk index over the full text of a set of uploads, built once per unique content and reused across calls."""
+    size = max(100, env_int("DOC_CHUNK_CHARS", 800))
+    keys = []
+    for f in documents or []:
+        try:
+            keys.append((os.path.basename(f), file_digest(f)))
+        except OSError:
+            continue
+    key = (tuple(keys), size)
+    with _lock:
+        hit = _indexes.get(key)
+        if hit is not None:
+            _indexes.move_to_end(key)
+            return hit
+    with _build_lock:
+        with _lock:
+            hit = _indexes.get(key)
+        if hit is not None:
+            return hit
+        idx = _build(documents, size)
+        with _lock:
+            _indexes[key] = idx
+            while len(_indexes) > 16:
+                _indexes.popitem(last=False)
+    return idx
+
+def _build(documents: List[str], size: int) -> ChunkIndex:
+    from .parsers import parse_file_full
+    idx = ChunkIndex()
+    for f in documents or []:
+        try:
+            # Full text, not the DOC_EXTRACT_MAX_CHARS summary: the sections that matter may be deep in the file
+            fragment = parse_file_full(f)
+        except Exception:
+            continue
+        for label, v in fragment.items():
+            if isinstance(v, dict) and v.get("content"):
+                idx.add(label, v.get("file", ""), v["content"], size)
+    return idx
+
+def warm_index(documents: List[str]) -> None:
+    """Build the index for documents on a background thread; index_for() then finds it ready or waits for it."""
+    def build():
+        try:
+            index_for(documents)
+        except Exception:
+            logging.exception("Background index build failed")
+    threading.Thread(target=build, name="index-warm", daemon=True).start()
@@ -1,3 +1,50 @@
+def _num(v):
+    return f"{v:g}" if isinstance(v, float) else str(v)
+
+def _sizing_md(val, max_columns=30):
+    # Row counts and per-column profiles from the tabular profiler give real sizing signals
+    if "rows" not in val and "profile" not in val:
+        return ""
+    lines = [f"Rows: {val.get('rows', 'unknown')}; columns: {len(val.get('columns', []))}"]
+    profile = val.get("profile") or {}
+    if profile:
+        lines.append("")
+        lines.append("| column | type | null rate | distinct (est.) | range |")
+        lines.append("|---|---|---|---|---|")
+        for col, p in list(profile.items())[:max_columns]:
+            rng = f"{_num(p['min'])} .. {_num(p['max'])}" if "min" in p else ""
+            lines.append(f"| {col} | {p.get('type', '')} | {p.get('null_rate', 0):.1%} | {p.get('distinct_est', '')} | {rng} |")
+        if len(profile) > max_columns:
+            lines.append(f"... {len(profile) - max_columns} more columns")
+    return "\n".join(lines)
+
+def _schema_lines(node, name, depth, out, max_lines):
+    if len(out) >= max_lines:
+        return
+    desc = node.get("type", "unknown")
+    if "length" in node:
+        ln = node["length"]
+        desc += f" (length {ln['min']}..{ln['max']}, avg {ln['avg']})"
+    if node.get("samples"):
+        desc += " e.g. " + ", ".join(str(x) for x in node["samples"])
+    out.append("  " * depth + f"- {name}: {desc}")
+    for k, v in (node.get("keys") or {}).items():
+        _schema_lines(v, k, depth + 1, out, max_lines)
+    if node.get("items"):
+        _schema_lines(node["items"], "[]", depth + 1, out, max_lines)
+
+def _schema_md(val, max_lines=60):
+    # Inferred JSON structure replaces the bare top-level key list
+    schema = val.get("schema")
+    if not schema:
+        return ""
+    out = []
+    _schema_lines(schema, "(root)", 0, out, max_lines)
+    note = f"Schema inferred from {val.get('bytes_read', 0)} bytes"
+    if val.get("truncated"):
+        note += " (partial: size or memory limit reached)"
+    return note + ":\n\n" + "\n".join(out)
+
 def build_specs_md(data, prompt):
     parts = ["# Specification"]
     if prompt:
@@ -7,5 +54,8 @@ def build_specs_md(data, prompt):
         if isinstance(val, dict):
             parts.append(f"## {key} - {val.get('file','')}")
             parts.append(val.get("content", "")[:4000])
+            sizing = _sizing_md(val) or _schema_md(val)
+            if sizing:
+                parts.append(sizing)
     return "\n\n".join(parts)
 